@@ -1,5 +1,10 @@
-import sys, platform
-from . import wasi
+import sys, os, platform, asyncio, warnings
+from . import wasi, backends, instrumentation
+from .util import PathSet, dedupe_paths
+from .batch import run_many, iter_many
+from .executor import SandboxExecutor
+
+run_async = None
 
 if platform.system() == 'Windows':
   from .windows import *
@@ -11,8 +16,35 @@ elif platform.system() == 'FreeBSD':
   from .freebsd import *
 else:
   run = wasi.run
+  run_async = wasi.run_async
   get_python_paths = lambda: []
 
+if run_async is None:
+  # Platforms without an async launcher spawn through run() on a thread so
+  # async callers still get the native sandbox, the result is a Popen
+  async def run_async(cmd, id, **kwargs):
+    return await asyncio.to_thread(run, cmd, id, **kwargs)
+
+# Starts the slow path discovery on a background thread so it overlaps with the caller's startup
+if os.environ.get('SANDBOXPY_WARM_UP') and platform.system() == 'Linux':
+  warm_up_python_paths()
+
+def _get_seccomp_paths(env=None):
+  # Sandboxes can neither compile the seccomp filters nor write their cache so
+  # the broker compiles the ones the safeguards load and they're bound read only.
+  # Returns those paths and env pointing the sandbox at their directory.
+  from . import preflight
+  if not preflight.USE_SECCOMP or platform.system() != 'Linux':
+    return [], env
+  try:
+    paths = preflight.precompile_seccomp_filters()
+  except (ImportError, OSError) as ex:
+    warnings.warn('Unable to precompile the seccomp filters: {}'.format(ex))
+    return [], env
+  if env is not None:
+    env = dict(env, SANDBOXPY_SECCOMP_CACHE_DIR=os.path.dirname(paths[0]))
+  return paths, env
+
 def run_python(cmd,
                id,
                readable_paths=[],
@@ -22,21 +54,71 @@ def run_python(cmd,
                cwd=None,
                **kwargs):
   exe = sys.executable
-  if exe and not kwargs.get('force_wasi'):
-    try:
+  if kwargs.get('use_zygote') and platform.system() == 'Linux':
+    from . import zygote
+    zygote_kwargs = {k: v for k, v in kwargs.items() if k not in ('use_zygote', 'zygote_preimport', 'zygote_safeguards')}
+    return zygote.run_python(cmd,
+                             id,
+                             readable_paths = readable_paths,
+                             writable_paths = writable_paths,
+                             writable_paths_ensure_exists = writable_paths_ensure_exists,
+                             env = env,
+                             cwd = cwd,
+                             preimport = kwargs.get('zygote_preimport', zygote.DEFAULT_PREIMPORT),
+                             safeguards = kwargs.get('zygote_safeguards', False),
+                             **zygote_kwargs)
+  native = None if kwargs.get('force_wasi') else backends.get_native_backend()
+  if exe and native:
+    with instrumentation.launch(id, native.name):
+      with instrumentation.phase('get_python_paths'):
+        python_paths = get_python_paths()
+      seccomp_paths, env = _get_seccomp_paths(env)
       return run([os.path.abspath(exe)] + cmd,
                  id,
-                 readable_paths = get_python_paths() + readable_paths,
+                 readable_paths = python_paths + seccomp_paths + readable_paths,
                  writable_paths = writable_paths,
                  writable_paths_ensure_exists = writable_paths_ensure_exists,
                  env = env,
-                 cwd = cwd)
-    except FileNotFoundError:
-      pass
+                 cwd = cwd,
+                 **kwargs)
   return wasi.run_python(cmd,
                          id,
                          readable_paths = readable_paths,
                          writable_paths = writable_paths,
                          writable_paths_ensure_exists = writable_paths_ensure_exists,
                          env = env,
-                         cwd = cwd)
+                         cwd = cwd,
+                         **kwargs)
+
+async def run_python_async(cmd,
+                           id,
+                           readable_paths=[],
+                           writable_paths=[],
+                           writable_paths_ensure_exists=[],
+                           env=None,
+                           cwd=None,
+                           **kwargs):
+  exe = sys.executable
+  native = None if kwargs.get('force_wasi') else backends.get_native_backend()
+  if exe and native:
+    with instrumentation.launch(id, native.name):
+      # Discovery can take a while on its first call so keep it off the event loop
+      with instrumentation.phase('get_python_paths'):
+        python_paths = await asyncio.get_running_loop().run_in_executor(None, get_python_paths)
+      seccomp_paths, env = await asyncio.to_thread(get_seccomp_paths, env)
+      return await run_async([os.path.abspath(exe)] + cmd,
+                             id,
+                             readable_paths = python_paths + seccomp_paths + readable_paths,
+                             writable_paths = writable_paths,
+                             writable_paths_ensure_exists = writable_paths_ensure_exists,
+                             env = env,
+                             cwd = cwd,
+                             **kwargs)
+  return await wasi.run_python_async(cmd,
+                                     id,
+                                     readable_paths = readable_paths,
+                                     writable_paths = writable_paths,
+                                     writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                     env = env,
+                                     cwd = cwd,
+                                     **kwargs)
@@ -1,5 +1,6 @@
-import os, sys
-import . as sandboxpy
+import os, sys, threading, inspect
+from . import util
+from . import run
 
 HELP = """
 usage: SandboxPy [-h] [--id SANDBOX_ID] [--wr [WRITABLE_PATH ...]] [--ro [READ_ONLY_PATH ...]] -- [command [arg ...]]
@@ -58,13 +59,33 @@ if not id:
 if not cmd:
   show_help_and_die()
 
-proc = sandboxpy.run(cmd,
-                     id,
-                     readable_paths = readonly_paths,
-                     writable_paths = writable_paths,
-                     env = dict(os.environ),
-                     cwd = os.getcwd())
+# Let the sandbox use our stdio directly when the backend supports it, otherwise forward it
+inherit_stdio = 'stdout' in inspect.signature(run).parameters
+stdio = {'stdin': None, 'stdout': None, 'stderr': None} if inherit_stdio else {}
 
-# TODO: IO handling
+proc = run(cmd,
+           id,
+           readable_paths = readonly_paths,
+           writable_paths = writable_paths,
+           env = dict(os.environ),
+           cwd = os.getcwd(),
+           **stdio)
+
+def forward_stdin():
+  try:
+    util.forward_fd(sys.stdin.fileno(), proc.stdin.fileno())
+  finally:
+    proc.stdin.close()
+
+if not inherit_stdio:
+  # stdin is a daemon since it may never hit EOF, e.g. on a terminal
+  threading.Thread(target=forward_stdin, daemon=True).start()
+  output_threads = [threading.Thread(target=util.forward_fd, args=(proc.stdout.fileno(), sys.stdout.fileno()))]
+  if proc.stderr is not proc.stdout:
+    output_threads.append(threading.Thread(target=util.forward_fd, args=(proc.stderr.fileno(), sys.stderr.fileno())))
+  for thread in output_threads:
+    thread.start()
+  for thread in output_threads:
+    thread.join()
 
 sys.exit(proc.wait())
@@ -0,0 +1,133 @@
+import os, hashlib, weakref, warnings, threading, subprocess
+from . import util, backends
+
+# Modules are precompiled once per content hash and runtime version and launched
+# from the compiled artifact, the least recently used artifacts are evicted once
+# the cache grows past MAX_CACHE_SIZE bytes
+USE_AOT_CACHE = not os.environ.get('SANDBOXPY_NO_AOT_CACHE')
+MAX_CACHE_SIZE = int(os.environ.get('SANDBOXPY_AOT_CACHE_SIZE', 2 << 30))
+
+EXTENSIONS = {'wasmtime': '.cwasm', 'wasmtime-py': '.cwasm'}
+
+_lock = threading.Lock()
+# Locks only live while a compile or lookup of their artifact holds them
+_compile_locks = weakref.WeakValueDictionary()
+_hashes = {}
+_versions = {}
+stats = {'hits': 0, 'misses': 0, 'compile_failures': 0, 'evictions': 0}
+
+def get_cache_dir():
+  return os.path.join(util.get_cache_dir(), 'wasi_aot')
+
+def get_stats():
+  with _lock:
+    return dict(stats)
+
+def _count(name):
+  with _lock:
+    stats[name] += 1
+
+def get_runtime_version(runtime_name, runtime):
+  backend = backends.get_backend(runtime_name)
+  if backend is not None and backend.path == runtime and backend.version:
+    return backend.version
+  version = _versions.get(runtime)
+  if version is None:
+    out = subprocess.run([runtime, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    version = _versions[runtime] = out.stdout.decode().strip()
+  return version
+
+def get_module_hash(path):
+  # Hashing large modules isn't free so it's redone only when the file changes
+  st = os.stat(path)
+  fingerprint = (st.st_size, st.st_mtime_ns, st.st_ino)
+  cached = _hashes.get(path)
+  if cached is not None and cached[0] == fingerprint:
+    return cached[1]
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      h.update(chunk)
+  _hashes[path] = (fingerprint, h.hexdigest())
+  return h.hexdigest()
+
+def is_compilable(path):
+  # webc packages and modules which are already compiled are passed through as is
+  try:
+    with open(path, 'rb') as f:
+      return f.read(4) == b'\x00asm'
+  except OSError:
+    return False
+
+def get_artifact_path(runtime_name, version, path):
+  key = hashlib.sha256('\0'.join((runtime_name, version, get_module_hash(path))).encode()).hexdigest()
+  return os.path.join(get_cache_dir(), key + EXTENSIONS[runtime_name])
+
+def get_cached(artifact, path, compile):
+  # compile(tmp) writes the compiled form of path to tmp
+  with _lock:
+    compile_lock = _compile_locks.setdefault(artifact, threading.Lock())
+  with compile_lock:
+    try:
+      # The mtime doubles as the last use time for eviction
+      os.utime(artifact)
+      _count('hits')
+      return artifact
+    except FileNotFoundError:
+      pass
+    _count('misses')
+    os.makedirs(get_cache_dir(), mode=0o700, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(artifact, os.getpid())
+    try:
+      compile(tmp)
+      os.replace(tmp, artifact)
+    except Exception as ex:
+      _count('compile_failures')
+      warnings.warn('Unable to precompile {}, running it directly: {}'.format(path, ex))
+      try: os.remove(tmp)
+      except OSError: pass
+      return None
+  evict()
+  return artifact
+
+def get_precompiled(runtime_name, runtime, path):
+  if not is_compilable(path):
+    return None
+  try:
+    artifact = get_artifact_path(runtime_name, get_runtime_version(runtime_name, runtime), path)
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  def compile(tmp):
+    subprocess.run([runtime, 'compile', path, '-o', tmp],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+  return get_cached(artifact, path, compile)
+
+def evict(max_size=None):
+  if max_size is None:
+    max_size = MAX_CACHE_SIZE
+  d = get_cache_dir()
+  entries = []
+  try:
+    with os.scandir(d) as it:
+      for entry in it:
+        if entry.name.endswith(tuple(EXTENSIONS.values())):
+          st = entry.stat()
+          entries.append((st.st_mtime, st.st_size, entry.path))
+  except FileNotFoundError:
+    return
+  total = sum(i[1] for i in entries)
+  for _, size, path in sorted(entries):
+    if total <= max_size:
+      break
+    try:
+      os.remove(path)
+      _count('evictions')
+    except FileNotFoundError:
+      pass
+    total -= size
+
+def clear_cache():
+  evict(0)
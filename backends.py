@@ -0,0 +1,177 @@
+import os, re, stat, shutil, platform, threading, subprocess, collections, importlib.util, importlib.metadata
+from . import util
+
+# Backends are probed once per process and then looked up directly, set
+# SANDBOXPY_BACKEND_CACHE to share the probe results between processes on disk
+USE_BACKEND_CACHE = bool(os.environ.get('SANDBOXPY_BACKEND_CACHE'))
+BACKEND_CACHE_NAME = 'backends.json'
+
+NATIVE_BACKENDS = {
+  'Linux': 'bwrap',
+  'Darwin': 'sandbox-exec',
+  'FreeBSD': 'jail',
+  'Windows': 'windows',
+}
+
+# bwrap flags which newer features depend on, checked against bwrap --help
+BWRAP_FLAGS = ('--args', '--die-with-parent', '--userns', '--pidns', '--disable-userns', '--unshare-all', '--share-net')
+
+Backend = collections.namedtuple('Backend', 'name path version capabilities')
+
+_lock = threading.Lock()
+_backends = {}
+
+def _run(cmd):
+  try:
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, timeout=10)
+    return out.returncode, out.stdout.decode(errors='replace')
+  except (OSError, subprocess.TimeoutExpired):
+    return None, ''
+
+def _get_version(path):
+  rc, out = _run([path, '--version'])
+  return out.strip() if rc == 0 else None
+
+def _probe_bwrap():
+  path = shutil.which('bwrap')
+  if not path:
+    return None
+  _, usage = _run([path, '--help'])
+  flags = [i for i in BWRAP_FLAGS if re.search(re.escape(i) + r'\b', usage)]
+  # Unprivileged user namespaces are commonly disabled by distros so check that they actually work
+  true = shutil.which('true') or '/bin/true'
+  rc, _ = _run([path, '--unshare-user', '--ro-bind', '/', '/', true])
+  # A setuid bwrap can still sandbox without them
+  setuid = bool(os.stat(path).st_mode & stat.S_ISUID)
+  return Backend('bwrap', path, _get_version(path), {'userns': rc == 0, 'setuid': setuid, 'flags': flags})
+
+def _probe_which(name, version=True):
+  def probe():
+    path = shutil.which(name)
+    if not path:
+      return None
+    return Backend(name, path, _get_version(path) if version else None, {})
+  return probe
+
+def _probe_pywasix():
+  # pywasix is only imported when it's used since importing it warns
+  if importlib.util.find_spec('pywasm') is None:
+    return None
+  return Backend('pywasix', None, None, {})
+
+def _probe_wasmtime_py():
+  # The wasmtime python bindings, imported only when the embedded backend is used
+  if importlib.util.find_spec('wasmtime') is None:
+    return None
+  try:
+    version = importlib.metadata.version('wasmtime')
+  except importlib.metadata.PackageNotFoundError:
+    version = None
+  return Backend('wasmtime-py', None, version, {})
+
+def _probe_windows():
+  if platform.system() != 'Windows':
+    return None
+  return Backend('windows', None, platform.version(), {})
+
+PROBES = {
+  'bwrap': _probe_bwrap,
+  'mbox': _probe_which('mbox', version=False),
+  'sandbox-exec': _probe_which('sandbox-exec', version=False),
+  'jail': _probe_which('jail', version=False),
+  'windows': _probe_windows,
+  'wasmer': _probe_which('wasmer'),
+  'wasmtime': _probe_which('wasmtime'),
+  'pywasix': _probe_pywasix,
+  'wasmtime-py': _probe_wasmtime_py,
+}
+
+# Only executables found on PATH are worth caching on disk
+DISK_CACHED = ('bwrap', 'mbox', 'sandbox-exec', 'jail', 'wasmer', 'wasmtime')
+
+def _get_mtime(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+def _load_disk_cache():
+  data = util.load_cache(BACKEND_CACHE_NAME)
+  if not data or data.get('path') != os.environ.get('PATH'):
+    return {}
+  backends = {}
+  for name, entry in data.get('backends', {}).items():
+    if entry is None:
+      backends[name] = None
+    elif _get_mtime(entry['path']) == entry['mtime']:
+      backends[name] = Backend(name, entry['path'], entry['version'], entry['capabilities'])
+  return backends
+
+def _save_disk_cache():
+  # Entries probed by other processes are kept
+  data = util.load_cache(BACKEND_CACHE_NAME)
+  entries = data.get('backends', {}) if data and data.get('path') == os.environ.get('PATH') else {}
+  for name in DISK_CACHED:
+    if name not in _backends:
+      continue
+    backend = _backends[name]
+    if backend is None:
+      entries[name] = None
+    else:
+      entries[name] = dict(backend._asdict(), mtime=_get_mtime(backend.path))
+  util.save_cache(BACKEND_CACHE_NAME, {'path': os.environ.get('PATH'), 'backends': entries})
+
+def get_backend(name):
+  # Returns the Backend or None when it isn't available
+  try:
+    return _backends[name]
+  except KeyError:
+    pass
+  with _lock:
+    if name not in _backends:
+      if USE_BACKEND_CACHE and name in DISK_CACHED:
+        cached = _load_disk_cache()
+        if name in cached:
+          _backends[name] = cached[name]
+          return cached[name]
+      _backends[name] = PROBES[name]()
+      if USE_BACKEND_CACHE and name in DISK_CACHED:
+        _save_disk_cache()
+    return _backends[name]
+
+def get_path(name):
+  backend = get_backend(name)
+  return None if backend is None else backend.path
+
+def is_usable(backend):
+  # bwrap is installed on plenty of systems where it can't create a sandbox,
+  # it needs either unprivileged user namespaces or to be setuid
+  if backend is None:
+    return False
+  if backend.name == 'bwrap':
+    return bool(backend.capabilities.get('userns') or backend.capabilities.get('setuid'))
+  return True
+
+def get_usable_path(name):
+  backend = get_backend(name)
+  return backend.path if is_usable(backend) else None
+
+def get_backends():
+  # Probes everything and returns the available backends by name
+  return {name: backend for name, backend in ((i, get_backend(i)) for i in PROBES) if backend is not None}
+
+def get_native_backend():
+  name = NATIVE_BACKENDS.get(platform.system())
+  backend = None if name is None else get_backend(name)
+  return backend if is_usable(backend) else None
+
+def supports_flag(name, flag):
+  backend = get_backend(name)
+  return backend is not None and flag in backend.capabilities.get('flags', ())
+
+def refresh(disk_cache=True):
+  with _lock:
+    _backends.clear()
+    if disk_cache:
+      try: os.remove(os.path.join(util.get_cache_dir(), BACKEND_CACHE_NAME))
+      except FileNotFoundError: pass
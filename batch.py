@@ -0,0 +1,115 @@
+import os, sys, time, functools, itertools, threading, subprocess, collections, concurrent.futures
+from . import util, backends
+
+JobResult = collections.namedtuple('JobResult', 'index cmd returncode stdout stderr start_time duration error')
+
+def _normalize_job(job, env, cwd):
+  if isinstance(job, dict):
+    return job['cmd'], job.get('input'), job.get('env', env), job.get('cwd', cwd)
+  return job, None, env, cwd
+
+class _RunningProcs(object):
+  # Processes of the jobs in flight, so they can be killed if the batch is abandoned
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._procs = set()
+    self._stopped = False
+
+  def add(self, proc):
+    with self._lock:
+      self._procs.add(proc)
+      if self._stopped:
+        proc.kill()
+
+  def discard(self, proc):
+    with self._lock:
+      self._procs.discard(proc)
+
+  def kill_all(self):
+    with self._lock:
+      self._stopped = True
+      procs = list(self._procs)
+    for proc in procs:
+      try:
+        proc.kill()
+      except OSError:
+        pass
+
+def _run_job(run, index, job, id, paths, env, cwd, timeout, kwargs, running):
+  cmd, input, env, cwd = _normalize_job(job, env, cwd)
+  start_time = time.monotonic()
+  returncode, stdout, stderr, error = None, None, None, None
+  try:
+    proc = run(cmd, id, env=env, cwd=cwd, **paths, **kwargs)
+    running.add(proc)
+    try:
+      stdout, stderr = proc.communicate(input, timeout)
+    except subprocess.TimeoutExpired as ex:
+      proc.kill()
+      stdout, stderr = proc.communicate()
+      error = ex
+    finally:
+      running.discard(proc)
+    returncode = proc.poll()
+  except Exception as ex:
+    error = ex
+  return JobResult(index, cmd, returncode, stdout, stderr, start_time, time.monotonic() - start_time, error)
+
+def _resolve_run(kwargs):
+  # Picks the backend once for the whole batch so jobs skip run()'s per call dispatch
+  from . import wasi
+  native = backends.get_native_backend()
+  if native is None or kwargs.get('force_wasi'):
+    return wasi.run
+  if native.name == 'bwrap' and not kwargs.get('persistent'):
+    from . import linux
+    return functools.partial(linux.run_bwrap, bwrap=native.path)
+  from . import run
+  return run
+
+def iter_many(jobs,
+              id,
+              readable_paths=[],
+              writable_paths=[],
+              writable_paths_ensure_exists=[],
+              env=None,
+              cwd=None,
+              max_parallel=None,
+              timeout=None,
+              python=False,
+              run=None,
+              **kwargs):
+  if run is None:
+    run = _resolve_run(kwargs)
+  # Everything shared by the batch is resolved once up front rather than per job
+  if python:
+    from . import get_python_paths
+    exe = os.path.abspath(sys.executable)
+    jobs = [dict(i, cmd=[exe]+i['cmd']) if isinstance(i, dict) else [exe]+i for i in jobs]
+    readable_paths = get_python_paths() + readable_paths
+  paths = {
+    'readable_paths': util.dedupe_paths(readable_paths),
+    'writable_paths': util.dedupe_paths(writable_paths),
+    'writable_paths_ensure_exists': list(writable_paths_ensure_exists),
+  }
+  # Jobs are only submitted as slots free up so a consumer which stops early
+  # doesn't leave the rest of the batch queued behind it
+  parallel = max_parallel or os.cpu_count()
+  jobs = enumerate(jobs)
+  running = _RunningProcs()
+  executor = concurrent.futures.ThreadPoolExecutor(parallel)
+  submit = lambda index, job: executor.submit(_run_job, run, index, job, id, paths, env, cwd, timeout, kwargs, running)
+  try:
+    pending = {submit(index, job) for index, job in itertools.islice(jobs, parallel)}
+    while pending:
+      done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      pending |= {submit(index, job) for index, job in itertools.islice(jobs, len(done))}
+      for future in done:
+        yield future.result()
+  finally:
+    # Only has work to do when the consumer stopped early or a job raised
+    running.kill_all()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def run_many(jobs, id, **kwargs):
+  return sorted(iter_many(jobs, id, **kwargs), key=lambda i: i.index)
@@ -0,0 +1,192 @@
+import os, sys, time, json, math, shutil, tempfile, argparse, platform, subprocess
+
+PACKAGE = __package__ or 'sandboxpy'
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_ID = 'sandboxpy_bench'
+DEFAULT_PARALLELISM = [1, 2, 4, 8]
+DEFAULT_MIRROR_SIZES = [10, 100, 1000]
+
+def percentile(samples, p):
+  samples = sorted(samples)
+  return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+def summarize(samples):
+  ms = [i * 1000 for i in samples]
+  return {
+    'n': len(ms),
+    'min_ms': min(ms),
+    'mean_ms': sum(ms) / len(ms),
+    'p50_ms': percentile(ms, 50),
+    'p90_ms': percentile(ms, 90),
+    'p99_ms': percentile(ms, 99),
+    'max_ms': max(ms),
+  }
+
+def time_calls(fn, iterations):
+  samples = []
+  for _ in range(iterations):
+    start = time.perf_counter()
+    fn()
+    samples.append(time.perf_counter() - start)
+  return samples
+
+def skipped(reason):
+  return {'skipped': reason}
+
+def _run_to_exit(run, cmd, **kwargs):
+  proc = run(cmd, BENCH_ID, **kwargs)
+  proc.communicate()
+  if proc.returncode != 0:
+    raise OSError(proc.returncode, 'Benchmark command failed: ' + ' '.join(cmd))
+
+def get_backends():
+  from . import wasi, backends as registry
+  backends = {}
+  if platform.system() == 'Linux':
+    from . import linux
+    if registry.get_backend('bwrap'):
+      backends['bwrap'] = linux.run
+    if registry.get_backend('mbox'):
+      backends['mbox'] = linux.run_mbox
+  if registry.get_backend('wasmer') or registry.get_backend('wasmtime'):
+    backends['wasi'] = wasi.run
+  return backends
+
+def bench_get_python_paths(iterations):
+  from . import get_python_paths
+  code = ('import time,{0};t=time.perf_counter();{0}.get_python_paths();print(time.perf_counter()-t)').format(PACKAGE)
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_PARENT] + sys.path))
+  results = {}
+  for name, extra_env in (('cold', {'SANDBOXPY_NO_PATH_CACHE': '1'}), ('disk_cache', {})):
+    samples = []
+    # The first run primes the disk cache for this interpreter
+    for _ in range(iterations + 1):
+      out = subprocess.run([sys.executable, '-c', code], env=dict(env, **extra_env), capture_output=True, check=True)
+      samples.append(float(out.stdout))
+    samples.pop(0)
+    results[name] = summarize(samples)
+  get_python_paths()
+  results['warm'] = summarize(time_calls(get_python_paths, iterations))
+  return results
+
+def bench_spawn(backends, iterations):
+  from . import get_python_paths, wasi
+  results = {}
+  python_paths = get_python_paths()
+  true = shutil.which('true')
+  for name in ('bwrap', 'mbox', 'wasi'):
+    run = backends.get(name)
+    if run is None:
+      results[name] = skipped(name + ' is not installed')
+      continue
+    result = results[name] = {}
+    if name == 'wasi':
+      result['true'] = skipped('true is not a wasi module')
+      wasi_python = os.environ.get('WASI_PYTHON', wasi.DEFAULT_WASI_PYTHON)
+      if not os.path.exists(wasi_python):
+        result['python'] = skipped('WASI_PYTHON not found')
+        continue
+      cmds = {'python': [wasi_python, '-c', 'pass']}
+      kwargs = {}
+    else:
+      cmds = {'true': [true], 'python': [sys.executable, '-c', 'pass']}
+      kwargs = {'readable_paths': python_paths + [true]}
+    for cmd_name, cmd in cmds.items():
+      try:
+        _run_to_exit(run, cmd, **kwargs)
+        result[cmd_name] = summarize(time_calls(lambda: _run_to_exit(run, cmd, **kwargs), iterations))
+      except Exception as ex:
+        result[cmd_name] = skipped(repr(ex))
+  return results
+
+def bench_throughput(backends, jobs, parallelism):
+  from . import batch, get_python_paths
+  run = backends.get('bwrap') or backends.get('mbox')
+  if run is None:
+    return skipped('No native backend is installed')
+  true = shutil.which('true')
+  results = {}
+  for max_parallel in parallelism:
+    start = time.perf_counter()
+    out = batch.run_many([[true]] * jobs,
+                         BENCH_ID,
+                         readable_paths = get_python_paths() + [true],
+                         max_parallel = max_parallel,
+                         run = run)
+    elapsed = time.perf_counter() - start
+    failures = len([i for i in out if i.returncode != 0])
+    results[str(max_parallel)] = {
+      'jobs': jobs,
+      'seconds': elapsed,
+      'jobs_per_second': jobs / elapsed,
+      'failures': failures,
+      'latency': summarize([i.duration for i in out]),
+    }
+  return results
+
+def _make_tree(root, files):
+  for i in range(files):
+    d = os.path.join(root, 'd{}'.format(i // 100))
+    os.makedirs(d, exist_ok=True)
+    with open(os.path.join(d, 'f{}.py'.format(i)), 'wb') as f:
+      f.write(os.urandom(4096))
+
+def bench_wasi_mirror(sizes, iterations):
+  from . import wasi
+  results = {}
+  with tempfile.TemporaryDirectory(prefix='sandboxpy_bench_') as tmp:
+    for size in sizes:
+      root = os.path.join(tmp, str(size))
+      _make_tree(root, size)
+      def mirror():
+        wasi.get_wasi_command('wasmer', None, ['module.wasm'], BENCH_ID,
+                              readable_paths = [root], mirror_readable_paths = True)
+      try:
+        # The first call clones the whole tree, later ones only rescan it
+        cold = time_calls(mirror, 1)[0]
+        results[str(size)] = {'cold_ms': cold * 1000, 'warm': summarize(time_calls(mirror, iterations))}
+      except Exception as ex:
+        results[str(size)] = skipped(repr(ex))
+  wasi.delete_all_sandboxes()
+  return results
+
+def run_benchmarks(iterations=20, jobs=100, parallelism=DEFAULT_PARALLELISM, mirror_sizes=DEFAULT_MIRROR_SIZES):
+  backends = get_backends()
+  results = {
+    'python': sys.version,
+    'platform': platform.platform(),
+    'backends': sorted(backends),
+    'timestamp': time.time(),
+  }
+  benchmarks = (
+    ('get_python_paths', lambda: bench_get_python_paths(max(1, iterations // 4))),
+    ('spawn', lambda: bench_spawn(backends, iterations)),
+    ('throughput', lambda: bench_throughput(backends, jobs, parallelism)),
+    ('wasi_mirror', lambda: bench_wasi_mirror(mirror_sizes, max(1, iterations // 4))),
+  )
+  for name, fn in benchmarks:
+    try:
+      results[name] = fn()
+    except Exception as ex:
+      results[name] = skipped(repr(ex))
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m {}.bench'.format(PACKAGE), description='SandboxPy benchmarks')
+  parser.add_argument('--iterations', '-n', type=int, default=20, help='Samples per latency benchmark')
+  parser.add_argument('--jobs', '-j', type=int, default=100, help='Jobs per throughput level')
+  parser.add_argument('--parallelism', '-p', type=int, nargs='+', default=DEFAULT_PARALLELISM, help='Throughput parallelism levels')
+  parser.add_argument('--mirror-sizes', type=int, nargs='+', default=DEFAULT_MIRROR_SIZES, help='File counts for the wasi mirror benchmark')
+  parser.add_argument('--output', '-o', help='Write the results as JSON to this path instead of stdout')
+  args = parser.parse_args(argv)
+  results = run_benchmarks(args.iterations, args.jobs, args.parallelism, args.mirror_sizes)
+  out = json.dumps(results, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  else:
+    print(out)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,190 @@
+import os, shutil, hashlib, threading, warnings
+
+CGROUP_PREFIX = 'sandbox_py_'
+CPU_PERIOD = 100000
+CONTROLLERS = ('cpu', 'memory', 'pids', 'io')
+LIMITS = ('cpu_quota', 'memory_max', 'pids_max', 'io_weight')
+BROKER_CGROUP = 'sandboxpy_broker'
+# Moving the broker changes the cgroup of the host process, so it only happens when asked for
+MOVE_BROKER = bool(os.environ.get('SANDBOXPY_CGROUP_MOVE_BROKER'))
+
+_lock = threading.Lock()
+_cgroups = {}
+_parent = None
+
+class Cgroup(object):
+  def __init__(self, path):
+    self.path = path
+
+  def __repr__(self):
+    return '<Cgroup: {}>'.format(self.path)
+
+  def _write(self, name, value):
+    with open(os.path.join(self.path, name), 'w') as f:
+      f.write(str(value))
+
+  def _read(self, name):
+    try:
+      with open(os.path.join(self.path, name), 'r') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def set_limits(self, cpu_quota=None, memory_max=None, pids_max=None, io_weight=None):
+    self._write('cpu.max', 'max {}'.format(CPU_PERIOD) if cpu_quota is None
+                           else '{} {}'.format(int(cpu_quota * CPU_PERIOD), CPU_PERIOD))
+    self._write('memory.max', 'max' if memory_max is None else int(memory_max))
+    self._write('pids.max', 'max' if pids_max is None else int(pids_max))
+    if io_weight is not None:
+      self._write('io.weight', 'default {}'.format(int(io_weight)))
+
+  def get_usage(self):
+    usage = {}
+    for name in ('cpu.stat', 'io.stat'):
+      data = self._read(name)
+      if data is None:
+        continue
+      if name == 'cpu.stat':
+        for line in data.splitlines():
+          k, v = line.split()
+          usage['cpu.' + k] = int(v)
+      else:
+        for line in data.splitlines():
+          device, *stats = line.split()
+          for stat in stats:
+            k, v = stat.split('=')
+            usage['io.' + k] = usage.get('io.' + k, 0) + int(v)
+    for name in ('memory.current', 'memory.peak', 'pids.current', 'pids.peak'):
+      data = self._read(name)
+      if data is not None:
+        usage[name] = int(data)
+    return usage
+
+  def get_launcher(self):
+    # Sandboxes are started through sh which moves itself into the cgroup and
+    # then execs, preexec_fn isn't safe once the broker has threads
+    return [get_shell(), '-c', 'echo 0 > "$0" && exec "$@"', os.path.join(self.path, 'cgroup.procs')]
+
+
+def get_shell():
+  return shutil.which('sh') or '/bin/sh'
+
+def get_cgroup2_mount():
+  with open('/proc/self/mounts', 'r') as f:
+    for line in f:
+      sp = line.split()
+      if len(sp) > 2 and sp[2] == 'cgroup2':
+        return sp[1]
+  return None
+
+def get_own_cgroup():
+  with open('/proc/self/cgroup', 'r') as f:
+    for line in f:
+      if line.startswith('0::'):
+        return line[3:].strip()
+  return None
+
+def _check_controllers(path):
+  with open(os.path.join(path, 'cgroup.controllers'), 'r') as f:
+    available = f.read().split()
+  missing = [i for i in CONTROLLERS if i not in available]
+  if missing:
+    raise OSError('cgroup controllers are not delegated: ' + ' '.join(missing))
+
+def _enable_controllers(path):
+  _check_controllers(path)
+  with open(os.path.join(path, 'cgroup.subtree_control'), 'w') as f:
+    f.write(' '.join('+' + i for i in CONTROLLERS))
+
+def _move_to_leaf(root):
+  # A cgroup holding processes can't enable controllers for its children so
+  # the broker moves itself, the whole host process, into a leaf of its own
+  # first. Without SANDBOXPY_CGROUP_MOVE_BROKER limits fall back to rlimits instead.
+  with open(os.path.join(root, 'cgroup.procs'), 'r') as f:
+    if not f.read().split():
+      return
+  if not MOVE_BROKER:
+    raise OSError('{} holds processes, set SANDBOXPY_CGROUP_MOVE_BROKER to move the broker out of it'.format(root))
+  leaf = os.path.join(root, BROKER_CGROUP)
+  try: os.mkdir(leaf)
+  except FileExistsError: pass
+  with open(os.path.join(leaf, 'cgroup.procs'), 'w') as f:
+    f.write(str(os.getpid()))
+
+def get_parent_cgroup():
+  # SANDBOXPY_CGROUP_ROOT should be a delegated cgroup without processes in
+  # it, otherwise the broker's own cgroup is used if the broker may move out of it
+  global _parent
+  if _parent is None:
+    root = os.environ.get('SANDBOXPY_CGROUP_ROOT')
+    if not root:
+      mount, own = get_cgroup2_mount(), get_own_cgroup()
+      if mount is None or own is None:
+        raise OSError('cgroup v2 is not available')
+      root = os.path.join(mount, own.lstrip('/'))
+      _check_controllers(root)
+      _move_to_leaf(root)
+    path = os.path.join(root, 'sandboxpy')
+    _enable_controllers(root)
+    try: os.mkdir(path)
+    except FileExistsError: pass
+    _enable_controllers(path)
+    _parent = path
+  return _parent
+
+def get_cgroup(id):
+  with _lock:
+    cgroup = _cgroups.get(id)
+    if cgroup is None:
+      path = os.path.join(get_parent_cgroup(), CGROUP_PREFIX + hashlib.sha1(id.encode()).hexdigest()[:16])
+      try: os.mkdir(path)
+      except FileExistsError: pass
+      cgroup = _cgroups[id] = Cgroup(path)
+    return cgroup
+
+def delete_cgroup(id):
+  # Fails quietly while processes are left in it, delete_all_cgroups() gets those
+  with _lock:
+    cgroup = _cgroups.pop(id, None)
+  if cgroup is not None:
+    try:
+      os.rmdir(cgroup.path)
+    except OSError:
+      pass
+
+def get_rlimits(cpu_quota=None, memory_max=None, pids_max=None, io_weight=None):
+  # Without cgroups only memory_max can be approximated with RLIMIT_AS,
+  # RLIMIT_NPROC counts every process of the user rather than the sandbox's
+  if cpu_quota is not None or pids_max is not None or io_weight is not None:
+    warnings.warn('cpu_quota, pids_max and io_weight require cgroup v2 delegation and will not be enforced')
+  return {} if memory_max is None else {'RLIMIT_AS': int(memory_max)}
+
+def get_rlimit_launcher(**limits):
+  rlimits = get_rlimits(**limits)
+  if not rlimits:
+    return []
+  return [get_shell(), '-c', 'ulimit -v "$0" && exec "$@"', str(max(1, rlimits['RLIMIT_AS'] // 1024))]
+
+def prepare_limits(id, cpu_quota=None, memory_max=None, pids_max=None, io_weight=None, **kwargs):
+  # Returns the cgroup, if any, and a prefix for the command which applies the limits
+  limits = {'cpu_quota': cpu_quota, 'memory_max': memory_max, 'pids_max': pids_max, 'io_weight': io_weight}
+  if all(i is None for i in limits.values()):
+    return None, []
+  try:
+    cgroup = get_cgroup(id)
+    cgroup.set_limits(**limits)
+    return cgroup, cgroup.get_launcher()
+  except OSError:
+    return None, get_rlimit_launcher(**limits)
+
+def delete_all_cgroups():
+  with _lock:
+    _cgroups.clear()
+    if _parent is None:
+      return
+    for name in os.listdir(_parent):
+      if name.startswith(CGROUP_PREFIX):
+        try:
+          os.rmdir(os.path.join(_parent, name))
+        except OSError:
+          pass
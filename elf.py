@@ -0,0 +1,169 @@
+import os, mmap, struct, collections
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+LD_SO_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+
+# The compatibility check in Resolver keeps libraries for other architectures out,
+# so every common layout can be searched
+DEFAULT_LIB_DIRS = ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+
+ElfInfo = collections.namedtuple('ElfInfo', 'elf_class machine interpreter needed rpath runpath')
+
+def _read_cstr(buf, offset):
+  end = buf.find(b'\x00', offset)
+  return bytes(buf[offset:end if end >= 0 else len(buf)]).decode(errors='surrogateescape')
+
+def _parse_elf(m):
+  if m[:4] != b'\x7fELF':
+    return None
+  elf_class = m[4]
+  e = '<' if m[5] == 1 else '>'
+  machine, = struct.unpack_from(e+'H', m, 18)
+  if elf_class == 2:
+    phoff, = struct.unpack_from(e+'Q', m, 32)
+    phentsize, phnum = struct.unpack_from(e+'HH', m, 54)
+  else:
+    phoff, = struct.unpack_from(e+'I', m, 28)
+    phentsize, phnum = struct.unpack_from(e+'HH', m, 42)
+
+  loads, dynamic, interpreter = [], None, None
+  for i in range(phnum):
+    if elf_class == 2:
+      p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = struct.unpack_from(e+'IIQQQQQQ', m, phoff + i*phentsize)
+    else:
+      p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = struct.unpack_from(e+'IIIIIIII', m, phoff + i*phentsize)
+    if p_type == PT_LOAD:
+      loads.append((p_vaddr, p_offset, p_filesz))
+    elif p_type == PT_DYNAMIC:
+      dynamic = (p_offset, p_filesz)
+    elif p_type == PT_INTERP:
+      interpreter = _read_cstr(m, p_offset)
+
+  needed, rpath, runpath = [], [], []
+  if dynamic:
+    fmt, size = (e+'qQ', 16) if elf_class == 2 else (e+'iI', 8)
+    entries = []
+    for offset in range(dynamic[0], dynamic[0] + dynamic[1], size):
+      tag, val = struct.unpack_from(fmt, m, offset)
+      if tag == DT_NULL:
+        break
+      entries.append((tag, val))
+    strtab = None
+    for tag, val in entries:
+      if tag == DT_STRTAB:
+        for vaddr, offset, filesz in loads:
+          if vaddr <= val < vaddr + filesz:
+            strtab = val - vaddr + offset
+    if strtab is not None:
+      for tag, val in entries:
+        if tag == DT_NEEDED:
+          needed.append(_read_cstr(m, strtab + val))
+        elif tag == DT_RPATH:
+          rpath += filter(None, _read_cstr(m, strtab + val).split(':'))
+        elif tag == DT_RUNPATH:
+          runpath += filter(None, _read_cstr(m, strtab + val).split(':'))
+  return ElfInfo(elf_class, machine, interpreter, needed, rpath, runpath)
+
+def parse_elf(path):
+  try:
+    with open(path, 'rb') as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return _parse_elf(m)
+  except (OSError, ValueError, struct.error):
+    return None
+
+def parse_ld_so_cache(path='/etc/ld.so.cache'):
+  libs = {}
+  try:
+    with open(path, 'rb') as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        # Skip the old format section if the cache has one
+        start = m.find(LD_SO_CACHE_MAGIC)
+        if start < 0:
+          return libs
+        nlibs, = struct.unpack_from('=I', m, start+20)
+        for i in range(nlibs):
+          _, key, value = struct.unpack_from('=iII', m, start + 48 + i*24)
+          libs.setdefault(_read_cstr(m, start+key), []).append(_read_cstr(m, start+value))
+  except (OSError, ValueError, struct.error):
+    pass
+  return libs
+
+class Resolver(object):
+  def __init__(self, lib_dirs=[], ld_so_cache='/etc/ld.so.cache'):
+    self.cache = parse_ld_so_cache(ld_so_cache)
+    self.env_dirs = [i for i in os.environ.get('LD_LIBRARY_PATH', '').split(':') if i]
+    self.lib_dirs = list(lib_dirs) + DEFAULT_LIB_DIRS
+    self._infos = {}
+    self._dependencies = {}
+    # The dynamic linker satisfies dependencies on its own soname with itself
+    self.interpreters = {}
+
+  def get_info(self, path):
+    try:
+      return self._infos[path]
+    except KeyError:
+      info = self._infos[path] = parse_elf(path)
+      return info
+
+  def _is_compatible(self, path, info):
+    other = self.get_info(path)
+    return other is not None and other.elf_class == info.elf_class and other.machine == info.machine
+
+  def find_library(self, name, info, origin):
+    if '/' in name:
+      return name if os.path.exists(name) else None
+    interpreter = self.interpreters.get((info.elf_class, info.machine))
+    if interpreter and name == os.path.basename(interpreter):
+      return interpreter
+    dirs = [] if info.runpath else list(info.rpath)
+    dirs += self.env_dirs + info.runpath
+    candidates = [os.path.join(i.replace('${ORIGIN}', origin).replace('$ORIGIN', origin), name) for i in dirs]
+    candidates += self.cache.get(name, [])
+    candidates += [os.path.join(i, name) for i in self.lib_dirs]
+    for candidate in candidates:
+      if self._is_compatible(candidate, info):
+        return candidate
+    return None
+
+  def get_dependencies(self, path):
+    try:
+      return self._dependencies[path]
+    except KeyError:
+      pass
+    deps = []
+    info = self.get_info(path)
+    if info:
+      if info.interpreter:
+        deps.append(info.interpreter)
+        self.interpreters.setdefault((info.elf_class, info.machine), info.interpreter)
+      origin = os.path.dirname(os.path.abspath(path))
+      for name in info.needed:
+        lib = self.find_library(name, info, origin)
+        if lib:
+          deps.append(lib)
+    self._dependencies[path] = deps
+    return deps
+
+  def resolve(self, path):
+    result = set()
+    seen = set()
+    stack = [path]
+    while stack:
+      p = stack.pop()
+      if p in seen:
+        continue
+      seen.add(p)
+      for dep in self.get_dependencies(p):
+        result.add(dep)
+        stack.append(dep)
+    return result
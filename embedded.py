@@ -0,0 +1,200 @@
+import os, time, ctypes, hashlib, warnings, threading, subprocess, concurrent.futures
+from . import util, aot, mirror, backends, inprocess, instrumentation
+
+# Runs wasi modules on the wasmtime python bindings instead of the CLI. The
+# process shares one Engine and caches compiled modules so a run only has to
+# create a Store and instantiate, which is far cheaper than spawning wasmtime.
+USE_EMBEDDED = bool(os.environ.get('SANDBOXPY_EMBEDDED_WASMTIME'))
+# Runs which block on io hold a worker too so there are a few even on one cpu
+MAX_WORKERS = int(os.environ.get('SANDBOXPY_EMBEDDED_WORKERS', 0)) or max(4, os.cpu_count() or 1)
+MAX_CACHED_MODULES = 32
+
+# The engine's epoch is bumped this often while anything is running so that
+# stores get a chance to notice they've been killed
+EPOCH_TICK = 0.01
+
+_lock = threading.Lock()
+_engine = None
+_linker = None
+_executor = None
+_modules = {}
+_running = 0
+_running_changed = threading.Condition()
+
+def get_engine():
+  global _engine, _linker
+  with _lock:
+    if _engine is None:
+      import wasmtime
+      config = wasmtime.Config()
+      config.epoch_interruption = True
+      _engine = wasmtime.Engine(config)
+      _linker = wasmtime.Linker(_engine)
+      _linker.define_wasi()
+      threading.Thread(target=_tick_worker, args=(_engine,), daemon=True).start()
+    return _engine
+
+def _tick_worker(engine):
+  while True:
+    with _running_changed:
+      while _running == 0:
+        _running_changed.wait()
+    time.sleep(EPOCH_TICK)
+    engine.increment_epoch()
+
+def _add_running(n):
+  global _running
+  with _running_changed:
+    _running += n
+    _running_changed.notify_all()
+
+def _set_deadline_callback(store, is_killed):
+  # The bindings don't wrap epoch callbacks, this one keeps the store running
+  # on every tick until it's been killed
+  from wasmtime import _bindings as ffi
+  argtypes = ffi._wasmtime_store_epoch_deadline_callback.argtypes
+  @argtypes[1]
+  def callback(context, data, delta, kind):
+    if is_killed():
+      return ctypes.cast(ffi.wasmtime_error_new(b'killed'), ctypes.c_void_p).value
+    delta[0] = 1
+    kind[0] = 0 # WASMTIME_UPDATE_DEADLINE_CONTINUE
+    return 0
+  finalizer = argtypes[3](lambda data: None)
+  ffi.wasmtime_store_epoch_deadline_callback(store.ptr(), callback, None, finalizer)
+  # Both have to outlive the store
+  return callback, finalizer
+
+def get_executor():
+  global _executor
+  with _lock:
+    if _executor is None:
+      _executor = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix='sandboxpy_wasmtime')
+    return _executor
+
+def _compile(path, aot_cache):
+  import wasmtime
+  engine = get_engine()
+  if aot_cache and aot.is_compilable(path):
+    version = backends.get_backend('wasmtime-py').version or ''
+    def compile(tmp):
+      with open(tmp, 'wb') as f:
+        f.write(wasmtime.Module.from_file(engine, path).serialize())
+    artifact = aot.get_cached(aot.get_artifact_path('wasmtime-py', version, path), path, compile)
+    if artifact is not None:
+      return wasmtime.Module.deserialize_file(engine, artifact)
+  return wasmtime.Module.from_file(engine, path)
+
+def get_instance_pre(path, aot_cache=aot.USE_AOT_CACHE):
+  st = os.stat(path)
+  key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+  pre = _modules.get(key)
+  if pre is None:
+    with instrumentation.phase('compile'):
+      module = _compile(path, aot_cache)
+    get_engine()
+    pre = _linker.instantiate_pre(module)
+    with _lock:
+      _modules[key] = pre
+      while len(_modules) > MAX_CACHED_MODULES:
+        del _modules[next(iter(_modules))]
+  return pre
+
+def _get_writer(fd):
+  def write(data):
+    view = memoryview(data)
+    try:
+      while view:
+        view = view[os.write(fd, view):]
+    except OSError as ex:
+      return -ex.errno
+    return len(data)
+  return write
+
+
+class EmbeddedProcess(inprocess.InProcess):
+  def __init__(self, args, pre, preopens, env, stdin, stdout, stderr):
+    super().__init__(args, stdin, stdout, stderr)
+    import wasmtime
+    self._pre = pre
+    self._callbacks = None
+    config = self._config = wasmtime.WasiConfig()
+    config.argv = list(args)
+    config.env = [(str(k), str(v)) for k, v in env.items()]
+    for host_path, guest_path, mutable in preopens:
+      config.preopen_dir(host_path, guest_path, mutable)
+    stdin_fd, stdout_fd, stderr_fd = self.stdio_fds
+    config.stdin_file = '/dev/fd/{}'.format(stdin_fd)
+    config.stdout_custom = _get_writer(stdout_fd)
+    config.stderr_custom = _get_writer(stderr_fd)
+
+  def _execute(self):
+    import wasmtime
+    store = wasmtime.Store(get_engine())
+    store.set_epoch_deadline(1)
+    self._callbacks = _set_deadline_callback(store, lambda: self._killed)
+    store.set_wasi(self._config)
+    _add_running(1)
+    try:
+      instance = self._pre.instantiate(store)
+      instance.exports(store)['_start'](store)
+    except wasmtime.ExitTrap as ex:
+      return ex.code
+    except (wasmtime.Trap, wasmtime.WasmtimeError):
+      if self._killed:
+        raise inprocess.Killed()
+      raise
+    finally:
+      _add_running(-1)
+    return 0
+
+
+def get_preopens(id, readable_paths, writable_paths):
+  # Directories are preopened in place, read only unless they're writable, while
+  # readable files are mirrored so that their siblings aren't exposed
+  from . import wasi
+  preopens = []
+  files = []
+  for path in readable_paths:
+    if os.path.isdir(path):
+      preopens.append((path, path, False))
+    elif os.path.exists(path):
+      files.append(path)
+  for path in writable_paths:
+    if os.path.isdir(path):
+      preopens.append((path, path, True))
+    elif os.path.exists(path):
+      warnings.warn('The embedded wasmtime backend can only map directories, skipping ' + path)
+  if files:
+    md = os.path.join(wasi.get_mirror_dir(), hashlib.sha256(id.encode()).hexdigest())
+    dirs = {}
+    for path, mpath in mirror.mirror_paths(files, md).items():
+      dirs[os.path.dirname(mpath)] = os.path.dirname(os.path.abspath(path))
+    preopens += [(mdir, guest, False) for mdir, guest in dirs.items()]
+  return preopens
+
+def run(cmd,
+        id,
+        readable_paths=[],
+        writable_paths=[],
+        writable_paths_ensure_exists=[],
+        env=None,
+        cwd=None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        aot_cache=aot.USE_AOT_CACHE,
+        **kwargs):
+  with instrumentation.launch(id, 'wasmtime-py'):
+    with instrumentation.phase('build_command'):
+      dir_keep_alive_handles = []
+      for path in writable_paths_ensure_exists:
+        dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
+      pre = get_instance_pre(os.path.join(cwd or '', cmd[0]), aot_cache)
+      preopens = get_preopens(id, readable_paths, list(writable_paths) + list(writable_paths_ensure_exists))
+    with instrumentation.phase('spawn'):
+      proc = EmbeddedProcess(cmd, pre, preopens, {} if env is None else env, stdin, stdout, stderr)
+      proc.start(get_executor())
+    proc.dir_keep_alive_handles = dir_keep_alive_handles
+    instrumentation.track_process(proc)
+    return proc
@@ -0,0 +1,311 @@
+import os, sys, json, queue, base64, struct, pickle, builtins, threading, subprocess, concurrent.futures
+from . import streaming
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'executor_worker.py')
+PREFLIGHT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preflight.py')
+
+HEADER = struct.Struct('>Q')
+
+# Larger responses are treated as a misbehaving worker rather than read into memory
+MAX_RESPONSE_SIZE = int(os.environ.get('SANDBOXPY_EXECUTOR_MAX_RESPONSE', 1 << 28))
+
+# How much of a worker's stderr is kept to explain why it died
+STDERR_TAIL_SIZE = 1 << 16
+
+# The only types results can be made of, responses can't encode anything else
+RESULT_TYPES = (type(None), bool, int, float, complex, str, bytes, tuple, list, set, frozenset, dict)
+
+class RemoteTraceback(Exception):
+  # Set as the __cause__ of exceptions raised by tasks so the sandboxed traceback is shown
+  def __init__(self, tb):
+    self.tb = tb
+
+  def __str__(self):
+    return self.tb
+
+
+class RemoteError(Exception):
+  # Raised for exceptions from tasks which aren't builtin exception types
+  def __init__(self, type_name, message):
+    super().__init__(type_name, message)
+    self.type_name = type_name
+    self.message = message
+
+  def __str__(self):
+    return '{}: {}'.format(self.type_name, self.message)
+
+
+class InvalidResponse(ValueError):
+  pass
+
+
+def _decode_bytes(value):
+  if type(value) is not str:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  return base64.b64decode(value.encode('ascii'), validate=True)
+
+def _decode_number(value):
+  if type(value) not in (int, float):
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  return value
+
+def _decode_items(value):
+  if type(value) is not list:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  return value
+
+def _decode_pair(value):
+  if type(value) is not list or len(value) != 2:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  return value
+
+# Values other than lists, strings, numbers, booleans and None are sent as
+# JSON objects with a single key naming their type, see executor_worker.encode_value
+TAGS = {
+  'bytes': _decode_bytes,
+  'complex': lambda value: complex(*map(_decode_number, _decode_pair(value))),
+  'tuple': lambda value: tuple(_decode_items(value)),
+  'set': lambda value: set(_decode_items(value)),
+  'frozenset': lambda value: frozenset(_decode_items(value)),
+  'dict': lambda value: dict(map(_decode_pair, _decode_items(value))),
+}
+
+def _decode_object(obj):
+  if len(obj) != 1:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  (tag, value), = obj.items()
+  if tag not in TAGS:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  return TAGS[tag](value)
+
+def get_exception(type_name, message):
+  cls = getattr(builtins, type_name, None)
+  if isinstance(cls, type) and issubclass(cls, Exception):
+    try:
+      return cls(message)
+    except Exception:
+      pass
+  return RemoteError(type_name, message)
+
+def decode_response(data):
+  # Returns (ok, result or exception, peak rss), responses come from inside the
+  # sandbox so they're only ever read as tagged JSON which can't build anything
+  # but RESULT_TYPES
+  try:
+    response = json.loads(data, object_hook=_decode_object)
+  except (ValueError, TypeError, RecursionError) as ex:
+    raise InvalidResponse('Invalid response from sandboxed worker') from ex
+  if type(response) is not list or len(response) != 3:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  ok, value, rss = response
+  if type(ok) is not bool or type(rss) is not int:
+    raise InvalidResponse('Invalid response from sandboxed worker')
+  if ok:
+    return True, value, rss
+  if not (type(value) is tuple and len(value) == 3 and all(type(i) is str for i in value)):
+    raise InvalidResponse('Invalid error from sandboxed worker')
+  type_name, message, tb = value
+  ex = get_exception(type_name, message)
+  if tb:
+    ex.__cause__ = RemoteTraceback(tb)
+  return False, ex, rss
+
+
+class _Worker(object):
+  def __init__(self, proc):
+    self.proc = proc
+    self.tasks = 0
+    self.stderr_tail = streaming.RingBuffer(STDERR_TAIL_SIZE)
+    self._drainer = threading.Thread(target=self._drain_stderr, daemon=True)
+    self._drainer.start()
+
+  def _drain_stderr(self):
+    # stderr has to be read so that tasks which print can't block on a full pipe
+    fd = self.proc.stderr.fileno()
+    while True:
+      try:
+        b = os.read(fd, 65536)
+      except OSError:
+        break
+      if not b:
+        break
+      self.stderr_tail.write(b)
+
+  def call(self, data):
+    self.proc.stdin.write(HEADER.pack(len(data)))
+    self.proc.stdin.write(data)
+    self.proc.stdin.flush()
+    header = self.proc.stdout.read(HEADER.size)
+    if len(header) < HEADER.size:
+      raise EOFError
+    size, = HEADER.unpack(header)
+    if size > MAX_RESPONSE_SIZE:
+      raise InvalidResponse('Response of {} bytes from sandboxed worker is over the limit of {}'.format(size, MAX_RESPONSE_SIZE))
+    data = self.proc.stdout.read(size)
+    if len(data) < size:
+      raise EOFError
+    self.tasks += 1
+    return data
+
+  def get_error(self):
+    try:
+      returncode = self.proc.wait(1)
+    except subprocess.TimeoutExpired:
+      returncode = None
+    self._drainer.join(1)
+    msg = 'Sandboxed worker exited with code {}'.format(returncode)
+    stderr = self.stderr_tail.getvalue().decode(errors='replace').strip()
+    return concurrent.futures.BrokenExecutor(msg + (':\n' + stderr if stderr else ''))
+
+  def close(self, timeout=1):
+    try:
+      self.proc.stdin.close()
+    except OSError:
+      pass
+    try:
+      self.proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+      self.proc.kill()
+      self.proc.wait()
+    self._drainer.join(timeout)
+    for f in (self.proc.stdout, self.proc.stderr):
+      try:
+        f.close()
+      except OSError:
+        pass
+
+
+class SandboxExecutor(concurrent.futures.Executor):
+  # Runs python callables on up to max_workers long lived sandboxed interpreters.
+  # Callables and their arguments are pickled so they have to be importable
+  # inside the sandbox. Results are only ever read as tagged JSON so they have to
+  # be built from RESULT_TYPES, without cycles, exceptions come back as the builtin exception
+  # of the same name or RemoteError with the traceback as their cause. Workers are replaced after max_tasks_per_worker tasks or
+  # once their peak RSS passes max_worker_memory bytes.
+  def __init__(self,
+               id,
+               max_workers=None,
+               max_tasks_per_worker=None,
+               max_worker_memory=None,
+               readable_paths=[],
+               writable_paths=[],
+               writable_paths_ensure_exists=[],
+               env=None,
+               cwd=None,
+               preimport=[],
+               safeguards=False,
+               **kwargs):
+    self.id = id
+    self.max_workers = max_workers or os.cpu_count()
+    self.max_tasks_per_worker = max_tasks_per_worker
+    self.max_worker_memory = max_worker_memory
+    self._readable_paths = list(readable_paths) + [WORKER_PATH] + ([PREFLIGHT_PATH] if safeguards else [])
+    self._writable_paths = list(writable_paths)
+    self._writable_paths_ensure_exists = list(writable_paths_ensure_exists)
+    self._env = env
+    self._cwd = cwd
+    self._kwargs = kwargs
+    # Zygotes apply the safeguards themselves before running the worker
+    self._config = {
+      'path': [i for i in sys.path if i],
+      'preimport': list(preimport),
+      'safeguards': safeguards and not kwargs.get('use_zygote'),
+      'preflight': PREFLIGHT_PATH,
+    }
+    if kwargs.get('use_zygote'):
+      self._kwargs['zygote_safeguards'] = safeguards
+    self._queue = queue.SimpleQueue()
+    self._idle = threading.Semaphore(0)
+    self._threads = []
+    self._shutdown = False
+    self._shutdown_lock = threading.Lock()
+
+  def _start_worker(self):
+    from . import run_python
+    proc = run_python([WORKER_PATH, json.dumps(self._config)],
+                      self.id,
+                      readable_paths = self._readable_paths,
+                      writable_paths = self._writable_paths,
+                      writable_paths_ensure_exists = self._writable_paths_ensure_exists,
+                      env = self._env,
+                      cwd = self._cwd,
+                      **self._kwargs)
+    return _Worker(proc)
+
+  def _should_recycle(self, worker, rss):
+    if self.max_tasks_per_worker and worker.tasks >= self.max_tasks_per_worker:
+      return True
+    return bool(self.max_worker_memory and rss >= self.max_worker_memory)
+
+  def _work(self):
+    worker = None
+    try:
+      while True:
+        item = self._queue.get()
+        if item is None:
+          break
+        future, data = item
+        if not future.set_running_or_notify_cancel():
+          continue
+        try:
+          if worker is None:
+            worker = self._start_worker()
+          ok, value, rss = decode_response(worker.call(data))
+        except BaseException as ex:
+          # The task fails whatever went wrong and a worker in an unknown state
+          # isn't used again, one sending anything unexpected included
+          if worker is not None:
+            if isinstance(ex, (OSError, EOFError)):
+              ex = worker.get_error()
+            worker.close()
+            worker = None
+          future.set_exception(ex)
+          self._idle.release()
+          continue
+        if ok:
+          future.set_result(value)
+        else:
+          future.set_exception(value)
+        if self._should_recycle(worker, rss):
+          worker.close()
+          worker = None
+        self._idle.release()
+    finally:
+      if worker is not None:
+        worker.close()
+
+  def _adjust_threads(self):
+    # Like ThreadPoolExecutor, a new worker is only started when none are idle
+    if self._idle.acquire(timeout=0):
+      return
+    if len(self._threads) < self.max_workers:
+      t = threading.Thread(target=self._work, name='sandboxpy_executor_{}'.format(len(self._threads)), daemon=True)
+      t.start()
+      self._threads.append(t)
+
+  def submit(self, fn, /, *args, **kwargs):
+    data = pickle.dumps((fn, args, kwargs), pickle.HIGHEST_PROTOCOL)
+    with self._shutdown_lock:
+      if self._shutdown:
+        raise RuntimeError('cannot schedule new futures after shutdown')
+      future = concurrent.futures.Future()
+      self._queue.put((future, data))
+      self._adjust_threads()
+      return future
+
+  def shutdown(self, wait=True, *, cancel_futures=False):
+    with self._shutdown_lock:
+      self._shutdown = True
+      if cancel_futures:
+        while True:
+          try:
+            item = self._queue.get_nowait()
+          except queue.Empty:
+            break
+          if item is not None:
+            item[0].cancel()
+      for _ in self._threads:
+        self._queue.put(None)
+    if wait:
+      for t in self._threads:
+        t.join()
@@ -0,0 +1,109 @@
+# Runs inside the sandbox as a worker for executor.py
+# This is executed as a standalone script so it must not import anything from the package
+
+import os, sys, json, base64, struct, pickle, traceback, importlib.util
+
+HEADER = struct.Struct('>Q')
+
+def load_preflight(path):
+  spec = importlib.util.spec_from_file_location('sandboxpy_preflight', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def read_message(f):
+  header = f.read(HEADER.size)
+  if len(header) < HEADER.size:
+    raise EOFError
+  size, = HEADER.unpack(header)
+  data = f.read(size)
+  if len(data) < size:
+    raise EOFError
+  return data
+
+def write_message(f, data):
+  f.write(HEADER.pack(len(data)))
+  f.write(data)
+  f.flush()
+
+def get_peak_rss():
+  try:
+    import resource
+  except ImportError:
+    return 0
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+def get_type_name(ex):
+  cls = type(ex)
+  return cls.__qualname__ if cls.__module__ == 'builtins' else cls.__module__ + '.' + cls.__qualname__
+
+def get_error(ex):
+  return get_type_name(ex), str(ex), traceback.format_exc()
+
+def encode_value(value, parents=None):
+  # Turns a result into JSON that executor.decode_response reads back, lists
+  # and scalars are sent as they are and everything else is tagged with its type
+  cls = type(value)
+  if cls in (type(None), bool, int, float, str):
+    return value
+  if cls is bytes:
+    return {'bytes': base64.b64encode(value).decode('ascii')}
+  if cls is complex:
+    return {'complex': [value.real, value.imag]}
+  if cls not in (list, tuple, set, frozenset, dict):
+    raise TypeError('Unable to send a {} in the result of the task'.format(cls.__name__))
+  parents = set() if parents is None else parents
+  if id(value) in parents:
+    raise ValueError('Unable to send a result which contains itself')
+  parents.add(id(value))
+  try:
+    if cls is dict:
+      return {'dict': [[encode_value(k, parents), encode_value(v, parents)] for k, v in value.items()]}
+    items = [encode_value(i, parents) for i in value]
+    return items if cls is list else {cls.__name__: items}
+  finally:
+    parents.discard(id(value))
+
+def encode_response(ok, value):
+  return json.dumps([ok, encode_value(value), get_peak_rss()]).encode()
+
+def run_task(data):
+  # The broker doesn't unpickle anything from the sandbox so results are sent
+  # as tagged JSON and exceptions as their type name, message and traceback
+  try:
+    fn, args, kwargs = pickle.loads(data)
+    value = fn(*args, **kwargs)
+  except BaseException as ex:
+    return encode_response(False, get_error(ex))
+  try:
+    return encode_response(True, value)
+  except (TypeError, ValueError, RecursionError) as ex:
+    return encode_response(False, (get_type_name(ex), str(ex), ''))
+
+def main():
+  config = json.loads(sys.argv[1])
+  # The protocol gets its own copies of stdin and stdout so that tasks which
+  # print or read input can't corrupt it, their output goes to stderr instead
+  reader = os.fdopen(os.dup(0), 'rb')
+  writer = os.fdopen(os.dup(1), 'wb')
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+  os.dup2(2, 1)
+
+  sys.path.extend(i for i in config.get('path', []) if i not in sys.path)
+  for name in config.get('preimport', []):
+    __import__(name)
+  if config.get('safeguards'):
+    load_preflight(config['preflight']).enable_default_safeguards()
+
+  while True:
+    try:
+      data = read_message(reader)
+    except EOFError:
+      break
+    write_message(writer, run_task(data))
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,9 @@
 import sys, os, subprocess, json, glob, tempfile
-from . import util
+from . import util, instrumentation, streaming
 
 # TODO: rewrite to use non-privileged jails, do cleanup in SandboxedProcess
 
-class SandboxedProcess(subprocess.Popen):
+class SandboxedProcess(streaming.StreamingProcess, instrumentation.TracedProcess, subprocess.Popen):
   pass
 
 def _send_payload_to_warden(payload, env=None, cwd=None, check_return_code=False):
@@ -33,10 +33,13 @@ def run(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensure_exi
     'env': dict(os.environ if env is None else env),
     'cwd': cwd,
   }) + '\n'
-  dir_keep_alive_handles = []
-  for path in writable_paths_ensure_exists:
-    dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
-  proc = _send_payload_to_warden(payload)
+  with instrumentation.launch(id, 'jail'):
+    dir_keep_alive_handles = []
+    for path in writable_paths_ensure_exists:
+      dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
+    with instrumentation.phase('spawn'):
+      proc = _send_payload_to_warden(payload)
+    instrumentation.track_process(proc)
   proc.dir_keep_alive_handles = dir_keep_alive_handles
   return proc
 
@@ -45,9 +48,7 @@ def delete_all_sandboxes():
   _send_payload_to_warden(payload, check_return_code=True)
 
 def get_python_paths():
-  paths = set(['/libexec', '/usr/lib', '/usr/local/bin', '/usr/local/lib', '/lib'])
-  for path in glob.iglob('/var/run/ld-elf*.hints'):
-    util.add_path_if_unique(paths, path)
-  for path in [os.path.dirname(sys.executable), os.path.dirname(os.__file__)]:
-    util.add_path_if_unique(paths, path)
+  paths = util.PathSet(['/libexec', '/usr/lib', '/usr/local/bin', '/usr/local/lib', '/lib'])
+  paths.update(glob.iglob('/var/run/ld-elf*.hints'))
+  paths.update([os.path.dirname(sys.executable), os.path.dirname(os.__file__)])
   return list(paths)
@@ -0,0 +1,159 @@
+import os, sys, time, threading, subprocess
+from . import streaming, instrumentation
+
+class Killed(BaseException):
+  # Raised to stop a run, runtimes tend to only catch Exception
+  pass
+
+
+class ProcessHandle(streaming.StreamingProcess):
+  # Popen-like parts shared by handles whose process isn't a child of this
+  # one, subclasses set _done once returncode is final and implement send_signal()
+  def __repr__(self):
+    r = '<{}: returncode: {} args: {}>'.format(type(self).__name__, self.returncode, self.args)
+    if len(r) > 80:
+      return r[:76] + '...>'
+    return r
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    for f in (self.stdin, self.stdout, self.stderr):
+      if f is not None:
+        try:
+          f.close()
+        except OSError:
+          pass
+    self.wait()
+
+  def poll(self):
+    return self.returncode if self._done.is_set() else None
+
+  def wait(self, timeout=None):
+    if not self._done.wait(timeout):
+      raise subprocess.TimeoutExpired(self.args, timeout)
+    return self.returncode
+
+  def terminate(self):
+    self.send_signal(15)
+
+  def kill(self):
+    self.send_signal(9)
+
+  def _read_worker(self, pipe, queue):
+    while True:
+      b = pipe.read(65536)
+      if not b:
+        break
+      instrumentation.record_output(self)
+      queue.append(b)
+    pipe.close()
+
+  def communicate(self, input=None, timeout=None):
+    with self._lock:
+      if self._readers is None:
+        self._readers = []
+        for pipe in (self.stdout, self.stderr):
+          if pipe is None:
+            continue
+          queue = []
+          t = threading.Thread(target=self._read_worker, args=(pipe, queue), daemon=True)
+          t.start()
+          self._readers.append((t, queue))
+        if self.stdin is not None and not self.stdin.closed:
+          try:
+            if input:
+              self.stdin.write(input)
+            self.stdin.close()
+          except BrokenPipeError:
+            pass
+
+    end = None if timeout is None else time.monotonic() + timeout
+    for t, _ in self._readers:
+      t.join(None if end is None else max(0, end - time.monotonic()))
+      if t.is_alive():
+        raise subprocess.TimeoutExpired(self.args, timeout)
+    self.wait(None if end is None else max(0, end - time.monotonic()))
+    out = [b''.join(queue) for _, queue in self._readers]
+    return (out.pop(0) if self.stdout is not None else None,
+            out.pop(0) if self.stderr is not None else None)
+
+
+class InProcess(ProcessHandle):
+  # Popen-like handle for a sandboxed run which executes on a thread in this
+  # process, subclasses implement _execute() and optionally _interrupt()
+  def __init__(self, args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    self.args = args
+    self.pid = os.getpid()
+    self.returncode = None
+    self.error = None
+    self.stdin = self.stdout = self.stderr = None
+    self._lock = threading.Lock()
+    self._readers = None
+    self._done = threading.Event()
+    self._killed = False
+    self._thread_ident = None
+    self._child_fds = []
+    fds = []
+    for name, value in (('stdin', stdin), ('stdout', stdout), ('stderr', stderr)):
+      if value == subprocess.STDOUT:
+        fds.append(fds[1])
+        continue
+      fds.append(self._get_child_fd(name, value))
+    self.stdio_fds = tuple(fds)
+
+  def _get_child_fd(self, name, value):
+    if value == subprocess.PIPE:
+      r, w = os.pipe()
+      child, parent = (r, w) if name == 'stdin' else (w, r)
+      setattr(self, name, open(parent, 'wb' if name == 'stdin' else 'rb'))
+      self._child_fds.append(child)
+      return child
+    if value is None:
+      return getattr(sys, '__' + name + '__').fileno()
+    if value == subprocess.DEVNULL:
+      fd = os.open(os.devnull, os.O_RDONLY if name == 'stdin' else os.O_WRONLY)
+      self._child_fds.append(fd)
+      return fd
+    if isinstance(value, (str, bytes, os.PathLike)):
+      fd = os.open(value, os.O_RDONLY if name == 'stdin' else os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+      self._child_fds.append(fd)
+      return fd
+    return value if isinstance(value, int) else value.fileno()
+
+  def start(self, executor=None):
+    if executor is None:
+      threading.Thread(target=self._run, daemon=True).start()
+    else:
+      executor.submit(self._run)
+
+  def _execute(self):
+    raise NotImplementedError
+
+  def _interrupt(self):
+    pass
+
+  def _run(self):
+    self._thread_ident = threading.get_ident()
+    try:
+      if self._killed:
+        raise Killed()
+      self.returncode = self._execute()
+    except Killed:
+      self.returncode = -9
+    except Exception as ex:
+      # Traps end the run like a crash would end a process
+      self.error = ex
+      self.returncode = 1
+    finally:
+      for fd in self._child_fds:
+        try: os.close(fd)
+        except OSError: pass
+      self._done.set()
+
+  def send_signal(self, sig):
+    if not self._done.is_set():
+      self._killed = True
+      if self._thread_ident is not None:
+        self._interrupt()
@@ -0,0 +1,221 @@
+import os, time, json, select, asyncio, threading, itertools, contextlib, contextvars
+
+# Listeners are called with a dict for every phase of every launch:
+# {'phase', 'id', 'backend', 'launch', 'start', 'duration', 'pid', 'thread', ...}
+# start and duration are in seconds from time.perf_counter()
+
+_listeners = []
+_launch_counter = itertools.count(1)
+_current = contextvars.ContextVar('sandboxpy_launch', default=None)
+
+def add_listener(listener):
+  _listeners.append(listener)
+
+def remove_listener(listener):
+  _listeners.remove(listener)
+
+def is_enabled():
+  return len(_listeners) > 0
+
+def emit(name, start, end, context=None, **fields):
+  event = dict(context or _current.get() or {})
+  event.pop('start', None)
+  event.update(fields)
+  event.update(phase=name, start=start, duration=end-start, pid=os.getpid(), thread=threading.get_ident())
+  for listener in list(_listeners):
+    listener(event)
+
+@contextlib.contextmanager
+def launch(id, backend):
+  if not _listeners:
+    yield
+    return
+  context = _current.get()
+  if context is not None and context['id'] == id:
+    # Launches nested in another for the same id, like run inside run_python, are reported as one
+    context['backend'] = backend
+    yield
+    return
+  token = _current.set({'id': id, 'backend': backend, 'launch': next(_launch_counter), 'start': time.perf_counter()})
+  try:
+    yield
+  finally:
+    _current.reset(token)
+
+@contextlib.contextmanager
+def detached():
+  # Launches inside this aren't joined to the current one, like the zygote which a persistent run starts
+  token = _current.set(None)
+  try:
+    yield
+  finally:
+    _current.reset(token)
+
+@contextlib.contextmanager
+def phase(name, **fields):
+  if not _listeners:
+    yield
+    return
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    emit(name, start, time.perf_counter(), **fields)
+
+
+class TracedProcess(object):
+  # Mixin for Popen subclasses which reports when the broker first sees the process exit
+  _trace = None
+
+  def _emit_exit(self):
+    context = self._trace
+    if context is not None and self.returncode is not None:
+      self._trace = None
+      emit('exit', context['start'], time.perf_counter(), context, returncode=self.returncode)
+
+  def poll(self):
+    returncode = super().poll()
+    self._emit_exit()
+    return returncode
+
+  def wait(self, timeout=None):
+    returncode = super().wait(timeout)
+    self._emit_exit()
+    return returncode
+
+def _bytes_available(fd):
+  import fcntl, termios, array
+  buf = array.array('i', [0])
+  fcntl.ioctl(fd, termios.FIONREAD, buf)
+  return buf[0]
+
+def record_output(proc):
+  # Called by readers of a tracked process's pipes whenever they get data
+  context = proc.__dict__.pop('_first_output', None)
+  if context is not None:
+    emit('first_output', context['start'], time.perf_counter(), context)
+
+class _OutputWatcher(object):
+  # One thread polls the pipes of every tracked process for callers that read
+  # them directly, nothing is consumed. A readable pipe with nothing in it was
+  # drained by the reader first unless its writers are gone, EOF is never
+  # reported as output. Readers can win the race for the data so
+  # record_output is the precise source.
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._entries = {}
+    self._thread = None
+    self._wake_fds = None
+
+  def add(self, proc, pipes):
+    with self._lock:
+      if self._thread is None:
+        self._wake_fds = os.pipe()
+        self._thread = threading.Thread(target=self._run, name='sandboxpy_first_output', daemon=True)
+        self._thread.start()
+      for pipe in pipes:
+        self._entries[pipe.fileno()] = (proc, pipe)
+    os.write(self._wake_fds[1], b'\0')
+
+  def _is_done(self, proc, pipe):
+    return pipe.closed or proc.returncode is not None or '_first_output' not in proc.__dict__
+
+  def _discard(self, fd, entry):
+    with self._lock:
+      if self._entries.get(fd) is entry:
+        del self._entries[fd]
+
+  def _run(self):
+    wake_fd = self._wake_fds[0]
+    while True:
+      poller = select.poll()
+      poller.register(wake_fd, select.POLLIN)
+      with self._lock:
+        for fd, (proc, pipe) in list(self._entries.items()):
+          if self._is_done(proc, pipe):
+            del self._entries[fd]
+          else:
+            poller.register(fd, select.POLLIN)
+        entries = dict(self._entries)
+      # Processes only count as exited once something polls them so the
+      # entries are checked again every 100ms while there are any
+      for fd, events in poller.poll(100 if entries else None):
+        if fd == wake_fd:
+          os.read(wake_fd, 4096)
+          continue
+        entry = entries[fd]
+        proc, pipe = entry
+        try:
+          if self._is_done(proc, pipe):
+            continue
+          if _bytes_available(fd) == 0 and events & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+            self._discard(fd, entry)
+            continue
+        except (OSError, ValueError):
+          self._discard(fd, entry)
+          continue
+        record_output(proc)
+
+_output_watcher = _OutputWatcher()
+
+def track_process(proc):
+  context = _current.get()
+  if not _listeners or context is None:
+    return
+  if isinstance(proc, asyncio.subprocess.Process):
+    _track_async_process(proc, context)
+    return
+  proc._trace = context
+  proc._first_output = context
+  pipes = [i for i in (proc.stdout, proc.stderr) if i is not None and hasattr(i, 'fileno')]
+  if pipes and hasattr(select, 'poll'):
+    _output_watcher.add(proc, pipes)
+
+def _track_async_process(proc, context):
+  # asyncio processes are read by the event loop so the first chunk fed to either reader is reported
+  proc._first_output = context
+  def wrap(reader):
+    feed_data = reader.feed_data
+    def traced_feed_data(data):
+      if data:
+        record_output(proc)
+      feed_data(data)
+    reader.feed_data = traced_feed_data
+  for reader in (proc.stdout, proc.stderr):
+    if reader is not None:
+      wrap(reader)
+  async def watch_exit():
+    returncode = await proc.wait()
+    emit('exit', context['start'], time.perf_counter(), context, returncode=returncode)
+  proc._trace_task = asyncio.ensure_future(watch_exit())
+
+
+class ChromeTraceExporter(object):
+  # Listener which collects events into the Chrome trace format that Perfetto and chrome://tracing load
+  def __init__(self):
+    self.events = []
+    self._lock = threading.Lock()
+
+  def __call__(self, event):
+    args = {k:v for k,v in event.items() if k not in ('phase', 'start', 'duration', 'pid', 'thread')}
+    trace_event = {
+      'name': event['phase'],
+      'cat': event.get('backend', 'sandboxpy'),
+      'ph': 'X',
+      'ts': event['start'] * 1e6,
+      'dur': event['duration'] * 1e6,
+      'pid': event['pid'],
+      # Each launch gets its own track since exit and first_output overlap other phases
+      'tid': event.get('launch', event['thread']),
+      'args': args,
+    }
+    with self._lock:
+      self.events.append(trace_event)
+
+  def to_json(self):
+    with self._lock:
+      return json.dumps({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, default=str)
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      f.write(self.to_json())
@@ -1,12 +1,92 @@
-import subprocess, sys, os, re, shutil, threading, glob, json, stat
-from . import util, wasi
+import subprocess, sys, os, re, shutil, threading, glob, json, stat, hashlib, concurrent.futures, asyncio, functools, tempfile, collections
+from . import util, wasi, elf, cgroups, backends, instrumentation, streaming
 
 _lock = threading.Lock()
+_warm_up_lock = threading.Lock()
+_warm_up_future = None
 
-class SandboxedProcess(subprocess.Popen): ...
+class SandboxedProcess(streaming.StreamingProcess, instrumentation.TracedProcess, subprocess.Popen):
+  cgroup = None
+
+  def get_resource_usage(self):
+    return self.cgroup.get_usage() if self.cgroup else None
+
+BwrapCommand = collections.namedtuple('BwrapCommand', 'cmd dir_keep_alive_handles args_fd bind_count')
 
 # TODO kwargs for allow printing, allow mbox, maybe allow proot
 
+# The binds are passed to bwrap through --args since the full python paths set can make argv very large
+@functools.lru_cache(maxsize=64)
+def get_bind_args(readable_paths, writable_paths, allow_networking=False):
+  args = []
+  if allow_networking:
+    args += ('--ro-bind-try', '/etc/resolv.conf', '/etc/resolv.conf') # TODO
+  for path in readable_paths:
+    args += ('--ro-bind-try', path, path)
+  for path in writable_paths:
+    args += ('--bind-try', path, path)
+  return b''.join(os.fsencode(i) + b'\0' for i in args)
+
+@functools.lru_cache(maxsize=64)
+def get_compacted_paths(paths, min_siblings=4, min_depth=2, deny_paths=tuple(util.DEFAULT_COMPACTION_DENY_PATHS)):
+  return tuple(util.compact_paths(paths, min_siblings, min_depth, deny_paths))
+
+def open_args_fd(data):
+  if hasattr(os, 'memfd_create'):
+    fd = os.memfd_create('sandboxpy_bwrap_args')
+  else:
+    with tempfile.TemporaryFile() as f:
+      fd = os.dup(f.fileno())
+  try:
+    view = memoryview(data)
+    while view:
+      view = view[os.write(fd, view):]
+    os.lseek(fd, 0, os.SEEK_SET)
+  except:
+    os.close(fd)
+    raise
+  return fd
+
+def get_bwrap_command(bwrap,
+                      cmd,
+                      readable_paths = [],
+                      writable_paths = [],
+                      writable_paths_ensure_exists = [],
+                      **kwargs):
+  bcmd = [
+    bwrap, 
+    '--die-with-parent',
+    '--dev', '/dev',
+    '--proc', '/proc',
+    '--tmpfs', '/tmp',
+    '--dir', '/var',
+    '--unshare-all'
+  ]
+  if kwargs.get('allow_networking'):
+    bcmd.append('--share-net')
+  dir_keep_alive_handles = []
+  for path in writable_paths_ensure_exists:
+    dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
+  readable_paths = tuple(readable_paths)
+  # Merges sibling binds into their parent to cut down on the mounts bwrap has to set up
+  compaction = kwargs.get('compact_readable_paths')
+  if compaction:
+    options = dict(compaction) if isinstance(compaction, dict) else {}
+    if 'deny_paths' in options:
+      options['deny_paths'] = tuple(options['deny_paths'])
+    readable_paths = get_compacted_paths(readable_paths, **options)
+  args = get_bind_args(readable_paths,
+                       tuple(writable_paths) + tuple(writable_paths_ensure_exists),
+                       bool(kwargs.get('allow_networking')))
+  if backends.supports_flag('bwrap', '--args'):
+    args_fd = open_args_fd(args)
+    bcmd += ('--args', str(args_fd))
+  else:
+    # Older bwrap gets the binds on the command line
+    args_fd = None
+    bcmd += [os.fsdecode(i) for i in args.split(b'\0')[:-1]]
+  return BwrapCommand(bcmd + cmd, dir_keep_alive_handles, args_fd, args.count(b'\0') // 3)
+
 def run(cmd,
         id,
         readable_paths = [],
@@ -14,8 +94,11 @@ def run(cmd,
         writable_paths_ensure_exists = [],
         env = None,
         cwd = None,
+        stdin = subprocess.PIPE,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
         **kwargs):
-  bwrap = shutil.which('bwrap')
+  bwrap = backends.get_usable_path('bwrap')
   if not bwrap or wasi.should_use_wasi(cmd[0], **kwargs):
     return wasi.run(cmd,
                     id,
@@ -24,37 +107,210 @@ def run(cmd,
                     writable_paths_ensure_exists = writable_paths_ensure_exists,
                     env = env,
                     cwd = cwd,
+                    stdin = stdin,
+                    stdout = stdout,
+                    stderr = stderr,
                     **kwargs)
-  bcmd = [
-    bwrap, 
-    '--die-with-parent',
-    '--dev', '/dev',
-    '--proc', '/proc',
-    '--tmpfs', '/tmp',
-    '--dir', '/var',
-    '--unshare-all'
-  ]
-  if kwargs.get('allow_networking'):
-    bcmd.append('--share-net')
-    bcmd += ('--ro-bind-try', '/etc/resolv.conf', '/etc/resolv.conf') # TODO
-  for path in readable_paths:
-    bcmd += ('--ro-bind-try', path, path)
-  for path in writable_paths:
-    bcmd += ('--bind-try', path, path)
-  dir_keep_alive_handles = []
-  for path in writable_paths_ensure_exists:
-    dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
-    bcmd += ('--bind-try', path, path)
-  proc = SandboxedProcess(
-            bcmd + cmd,
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            env=env,
-            cwd=cwd,
-          )
-  proc.dir_keep_alive_handles = dir_keep_alive_handles
-  return proc
+  if kwargs.get('persistent'):
+    return run_persistent(cmd,
+                          id,
+                          readable_paths = readable_paths,
+                          writable_paths = writable_paths,
+                          writable_paths_ensure_exists = writable_paths_ensure_exists,
+                          env = env,
+                          cwd = cwd,
+                          stdin = stdin,
+                          stdout = stdout,
+                          stderr = stderr,
+                          **kwargs)
+  return run_bwrap(cmd,
+                   id,
+                   readable_paths = readable_paths,
+                   writable_paths = writable_paths,
+                   writable_paths_ensure_exists = writable_paths_ensure_exists,
+                   env = env,
+                   cwd = cwd,
+                   stdin = stdin,
+                   stdout = stdout,
+                   stderr = stderr,
+                   bwrap = bwrap,
+                   **kwargs)
+
+def run_bwrap(cmd,
+              id,
+              readable_paths = [],
+              writable_paths = [],
+              writable_paths_ensure_exists = [],
+              env = None,
+              cwd = None,
+              stdin = subprocess.PIPE,
+              stdout = subprocess.PIPE,
+              stderr = subprocess.PIPE,
+              bwrap = None,
+              **kwargs):
+  # run() without the backend selection, used directly by callers which already picked bwrap
+  bwrap = bwrap or backends.get_usable_path('bwrap')
+  with instrumentation.launch(id, 'bwrap'):
+    with instrumentation.phase('build_command'):
+      bcmd = get_bwrap_command(bwrap,
+                               cmd,
+                               readable_paths = readable_paths,
+                               writable_paths = writable_paths,
+                               writable_paths_ensure_exists = writable_paths_ensure_exists,
+                               **kwargs)
+    stdio_files = []
+    try:
+      cgroup, launcher = cgroups.prepare_limits(id, **kwargs)
+      (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+      with instrumentation.phase('spawn'):
+        proc = SandboxedProcess(
+                launcher + bcmd.cmd,
+                stdin = stdin,
+                stdout = stdout,
+                stderr = stderr,
+                env=env,
+                cwd=cwd,
+                pass_fds=(() if bcmd.args_fd is None else (bcmd.args_fd,)) + tuple(kwargs.get('pass_fds', ())),
+              )
+    except:
+      # Nothing was started so the directories don't have to be kept alive
+      for handle in bcmd.dir_keep_alive_handles:
+        handle.close()
+      raise
+    finally:
+      if bcmd.args_fd is not None:
+        os.close(bcmd.args_fd)
+      for f in stdio_files:
+        f.close()
+    proc.dir_keep_alive_handles = bcmd.dir_keep_alive_handles
+    proc.bind_count = bcmd.bind_count
+    proc.cgroup = cgroup
+    instrumentation.track_process(proc)
+    return proc
+
+def run_persistent(cmd,
+                   id,
+                   readable_paths = [],
+                   writable_paths = [],
+                   writable_paths_ensure_exists = [],
+                   env = None,
+                   cwd = None,
+                   stdin = subprocess.PIPE,
+                   stdout = subprocess.PIPE,
+                   stderr = subprocess.PIPE,
+                   **kwargs):
+  # The first run with an id and set of paths starts a zygote holding the
+  # namespaces and mounts, later ones are forked from it inside the sandbox so
+  # nothing is set up again. The zygote is python so the python paths are
+  # readable by every command too, callers have to allow that explicitly.
+  # Limits are applied to each run on its own.
+  from . import zygote
+  if not kwargs.get('expose_python_paths'):
+    raise ValueError('Persistent sandboxes expose the python paths to the command, pass expose_python_paths=True to allow it')
+  kwargs = {k: v for k, v in kwargs.items() if k not in ('persistent', 'expose_python_paths')}
+  with instrumentation.launch(id, 'persistent'):
+    (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+    try:
+      with instrumentation.phase('spawn'):
+        proc = zygote.run(cmd,
+                          id,
+                          readable_paths = readable_paths,
+                          writable_paths = writable_paths,
+                          writable_paths_ensure_exists = writable_paths_ensure_exists,
+                          env = env,
+                          cwd = cwd,
+                          stdin = stdin,
+                          stdout = stdout,
+                          stderr = stderr,
+                          **kwargs)
+    finally:
+      for f in stdio_files:
+        f.close()
+    instrumentation.track_process(proc)
+    return proc
+
+def delete_all_sandboxes():
+  from . import zygote
+  zygote.shutdown_all()
+  cgroups.delete_all_cgroups()
+  wasi.delete_all_sandboxes()
+
+async def run_async(cmd,
+                    id,
+                    readable_paths = [],
+                    writable_paths = [],
+                    writable_paths_ensure_exists = [],
+                    env = None,
+                    cwd = None,
+                    stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE,
+                    stderr = subprocess.PIPE,
+                    **kwargs):
+  bwrap = backends.get_usable_path('bwrap')
+  if not bwrap or wasi.should_use_wasi(cmd[0], **kwargs):
+    return await wasi.run_async(cmd,
+                                id,
+                                readable_paths = readable_paths,
+                                writable_paths = writable_paths,
+                                writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                env = env,
+                                cwd = cwd,
+                                stdin = stdin,
+                                stdout = stdout,
+                                stderr = stderr,
+                                **kwargs)
+  if kwargs.get('persistent'):
+    from . import zygote
+    proc = await asyncio.to_thread(run_persistent,
+                                   cmd,
+                                   id,
+                                   readable_paths = readable_paths,
+                                   writable_paths = writable_paths,
+                                   writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                   env = env,
+                                   cwd = cwd,
+                                   stdin = stdin,
+                                   stdout = stdout,
+                                   stderr = stderr,
+                                   **kwargs)
+    return zygote.AsyncZygoteProcess(proc)
+  with instrumentation.launch(id, 'bwrap'):
+    with instrumentation.phase('build_command'):
+      bcmd = get_bwrap_command(bwrap,
+                               cmd,
+                               readable_paths = readable_paths,
+                               writable_paths = writable_paths,
+                               writable_paths_ensure_exists = writable_paths_ensure_exists,
+                               **kwargs)
+    stdio_files = []
+    try:
+      cgroup, launcher = cgroups.prepare_limits(id, **kwargs)
+      (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+      with instrumentation.phase('spawn'):
+        proc = await asyncio.create_subprocess_exec(
+                *launcher + bcmd.cmd,
+                stdin = stdin,
+                stdout = stdout,
+                stderr = stderr,
+                env=env,
+                cwd=cwd,
+                pass_fds=(() if bcmd.args_fd is None else (bcmd.args_fd,)) + tuple(kwargs.get('pass_fds', ())),
+              )
+    except:
+      # Nothing was started so the directories don't have to be kept alive
+      for handle in bcmd.dir_keep_alive_handles:
+        handle.close()
+      raise
+    finally:
+      if bcmd.args_fd is not None:
+        os.close(bcmd.args_fd)
+      for f in stdio_files:
+        f.close()
+    proc.dir_keep_alive_handles = bcmd.dir_keep_alive_handles
+    proc.bind_count = bcmd.bind_count
+    proc.cgroup = cgroup
+    instrumentation.track_process(proc)
+    return proc
 
 
 def run_mbox(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensure_exists=[], env=None, cwd=None):
@@ -80,92 +336,239 @@ def run_mbox(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensur
     with open(profile, 'w') as f:
       f.write(profile_data)
   mcmd = ['mbox', '-i', '-n', '-p', profile]
-  return SandboxedProcess(
-           mcmd + cmd,
-           stdin = subprocess.PIPE,
-           stdout = subprocess.PIPE,
-           stderr = subprocess.PIPE,
-           env=env,
-           cwd=cwd,
-         )
+  with instrumentation.launch(id, 'mbox'):
+    with instrumentation.phase('spawn'):
+      proc = SandboxedProcess(
+               mcmd + cmd,
+               stdin = subprocess.PIPE,
+               stdout = subprocess.PIPE,
+               stderr = subprocess.PIPE,
+               env=env,
+               cwd=cwd,
+             )
+    instrumentation.track_process(proc)
+  return proc
 
 
-python_paths = set()
+python_paths = util.PathSet()
+_python_paths_complete = False
+
+_elf_resolver = None
+
+def get_elf_resolver():
+  # Rebuilt whenever ldconfig rewrites the cache
+  global _elf_resolver
+  key = _get_mtime('/etc/ld.so.cache')
+  if _elf_resolver is None or _elf_resolver[0] != key:
+    _elf_resolver = (key, elf.Resolver(parse_so_conf('/etc/ld.so.conf')))
+  return _elf_resolver[1]
 
 def add_shared_object_paths_from_bins(bin_path):
-  p = subprocess.run(['ldd', bin_path], capture_output=True)
-  for line in p.stdout.splitlines():
-    sp = line.decode().split()
-    if os.path.isabs(sp[0]):
-      util.add_path_if_unique(python_paths, sp[0])
-    if len(sp) > 2:
-      util.add_path_if_unique(python_paths, sp[2])
-
-def parse_so_conf(path):
+  for path in get_elf_resolver().resolve(bin_path):
+    python_paths.add(path)
+
+# A row of the table strace -c writes, the errors column is blank when there were none
+STRACE_SUMMARY_ROW = re.compile(r'^\s*[\d.]+\s+[\d.]+\s+\d+\s+(\d+)\s+(?:\d+\s+)?(\w+)\s*$')
+
+def parse_strace_summary(text):
+  counts = collections.Counter()
+  for line in text.splitlines():
+    m = STRACE_SUMMARY_ROW.match(line)
+    if m and m.group(2) != 'total':
+      counts[m.group(2)] += int(m.group(1))
+  return counts
+
+def profile_syscalls(cmd, id, readable_paths=[], writable_paths=[], **kwargs):
+  # Runs cmd sandboxed under strace and returns how often it made each syscall,
+  # which preflight.get_minimal_whitelist() turns into a seccomp whitelist
+  strace = shutil.which('strace')
+  if not strace:
+    raise FileNotFoundError('Profiling syscalls requires strace')
+  with tempfile.TemporaryDirectory(prefix='sandboxpy_strace_') as d:
+    out = os.path.join(d, 'summary')
+    proc = run([strace, '-f', '-qq', '-c', '-o', out, '--'] + list(cmd),
+               id,
+               readable_paths = [strace] + list(get_elf_resolver().resolve(strace)) + list(readable_paths),
+               writable_paths = [d] + list(writable_paths),
+               **kwargs)
+    proc.communicate()
+    try:
+      with open(out, 'r') as f:
+        return parse_strace_summary(f.read())
+    except FileNotFoundError:
+      raise RuntimeError('strace failed with exit code {}'.format(proc.returncode))
+
+def parse_so_conf(path, lib_dirs=None, conf_paths=None):
+  # Returns the library dirs, the dirs of included confs are added to conf_paths if given
+  if lib_dirs is None:
+    lib_dirs = []
   if not os.path.exists(path):
-    return
+    return lib_dirs
   with open(path, 'r') as f:
     for line in f:
       line = line.strip()
       if line.startswith('include '):
         pathname = line[8:]
         for path in glob.iglob(pathname, recursive=True):
-          util.add_path_if_unique(python_paths, os.path.dirname(path))
-          parse_so_conf(path)
+          if conf_paths is not None:
+            conf_paths.add(os.path.dirname(path))
+          parse_so_conf(path, lib_dirs, conf_paths)
       elif line and not line.startswith('#'):
-        util.add_path_if_unique(python_paths, line)
+        lib_dirs.append(line)
+  return lib_dirs
+
+def _discover_python_paths():
+  module_dirs = set()
+  python_paths.add('/bin/sh')
+  python_paths.add(sys.executable)
+  add_shared_object_paths_from_bins(sys.executable)
+
+  # Get the paths of the files for every module
+  # Run this in a new instance to avoid leaking any already imported, broker-only paths to the sandbox
+  # socket, sqlite3 and threading are imported to ensure that paths for dynamically loaded modules are included in the sandbox
+  code = ("import json,sys,socket,sqlite3,threading,ssl;print(json.dumps(" +
+          "[[i.__file__ for i in filter(lambda i:hasattr(i,'__file__'),sys.modules.values())],sys.path]))")
+  module_files, sys_path = json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True).stdout)
+
+  for file in filter(lambda i: i is not None, module_files):
+    module_dir = os.path.dirname(file)
+    module_dirs.add(module_dir)
+    python_paths.add(module_dir)
+    if os.stat(file).st_mode & stat.S_IXOTH:
+      add_shared_object_paths_from_bins(file)
 
-def get_python_paths():
+  for path in sys_path:
+    if path and os.path.exists(path):
+      module_dirs.add(path)
+      python_paths.add(path)
+
+  # Needed for ctypes, which is used by pyseccomp
+  for path in glob.iglob('/sbin/ldconfig*'):
+    python_paths.add(path)
+  bin_names = ('gcc', 'cc', 'ldconfig', 'objdump')
+  for bin_name in bin_names:
+    bin_path = shutil.which(bin_name)
+    if bin_path:
+      python_paths.add(bin_path)
+      add_shared_object_paths_from_bins(bin_path)
+
+  special_cases = [
+    # glibc only lazy loads this library when canceling threads which is why
+    # it doesn't show up in in the regular headers
+    '/lib/libgcc_s.so*',
+    '/lib64/libgcc_s.so*',
+    '/usr/lib/libgcc_s.so*',
+    '/usr/lib64/libgcc_s.so*',
+  ]
+  for pattern in special_cases:
+    for path in glob.iglob(pattern):
+      python_paths.add(path)
+
+  python_paths.update(parse_so_conf('/etc/ld.so.conf', conf_paths=python_paths))
+  if os.path.exists('/etc/ld.so.cache'):
+    python_paths.add('/etc/ld.so.cache')
+  return module_dirs
+
+
+# Discovery is cached on disk since it spawns an interpreter and parses every
+# extension module. The cache is only reused if none of its inputs have changed.
+USE_PYTHON_PATHS_CACHE = not os.environ.get('SANDBOXPY_NO_PATH_CACHE')
+PYTHON_PATHS_CACHE_NAME = 'linux_python_paths_{}.json'
+# Environment variables that change the sys.path of the interpreter spawned by discovery
+PYTHON_PATH_VARS = ('PYTHONPATH', 'PYTHONHOME', 'PYTHONNOUSERSITE', 'PYTHONUSERBASE', 'PYTHONSAFEPATH')
+
+def _get_mtime(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+# The spawned interpreter gets its sys.path from the executable and the environment,
+# not from the broker's sys.path. Changes to site-packages and .pth files are caught
+# by the module_dirs mtimes stored in the cache
+def get_child_python_path_key():
+  data = [sys.executable] + [os.environ.get(i) for i in PYTHON_PATH_VARS]
+  return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+def get_python_paths_cache_name():
+  # One file per interpreter and environment so alternating between them doesn't thrash a single cache
+  return PYTHON_PATHS_CACHE_NAME.format(get_child_python_path_key()[:16])
+
+def get_python_paths_fingerprint():
+  files = [sys.executable, '/etc/ld.so.cache']
+  files += sorted(glob.glob('/etc/ld.so.conf*'))
+  files += sorted(glob.glob('/etc/ld.so.conf.d/*'))
+  data = {
+    'child_path_key': get_child_python_path_key(),
+    'mtimes': [(i, _get_mtime(i)) for i in files],
+  }
+  return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+def _load_cached_python_paths(fingerprint):
+  cache = util.load_cache(get_python_paths_cache_name())
+  if not isinstance(cache, dict) or cache.get('fingerprint') != fingerprint:
+    return None
+  for path, mtime in cache.get('module_dirs', {}).items():
+    if _get_mtime(path) != mtime:
+      return None
+  return cache.get('python_paths')
+
+def _save_cached_python_paths(fingerprint, module_dirs):
+  util.save_cache(get_python_paths_cache_name(), {
+    'fingerprint': fingerprint,
+    'module_dirs': {i: _get_mtime(i) for i in module_dirs},
+    'python_paths': sorted(python_paths),
+  })
+
+def get_python_paths(fallback=False):
+  if fallback and not is_python_paths_ready():
+    warm_up_python_paths()
+    return get_fallback_python_paths()
+  global _python_paths_complete
   with _lock:
-    if len(python_paths) < 1:
-      python_paths.add('/bin/sh')
-      python_paths.add(sys.executable)
-      has_ldd = shutil.which('ldd')
-      if has_ldd:
-        add_shared_object_paths_from_bins(sys.executable)
-
-      # Get the paths of the files for every module
-      # Run this in a new instance to avoid leaking any already imported, broker-only paths to the sandbox
-      # socket, sqlite3 and threading are imported to ensure that paths for dynamically loaded modules are included in the sandbox
-      code = ("import json,sys,socket,sqlite3,threading,ssl;print(json.dumps(" +
-              "[[i.__file__ for i in filter(lambda i:hasattr(i,'__file__'),sys.modules.values())],sys.path]))")
-      module_files, sys_path = json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True).stdout)
-
-      for file in filter(lambda i: i is not None, module_files):
-        module_dir = os.path.dirname(file)
-        util.add_path_if_unique(python_paths, module_dir)
-        if os.stat(file).st_mode & stat.S_IXOTH:
-          add_shared_object_paths_from_bins(file)
-
-      for path in sys_path:
-        if path and os.path.exists(path):
-          util.add_path_if_unique(python_paths, path)
-
-      # Needed for ctypes, which is used by pyseccomp
-      for path in glob.iglob('/sbin/ldconfig*'):
-        python_paths.add(path)
-      bin_names = ('gcc', 'cc', 'ldconfig', 'objdump')
-      for bin_name in bin_names:
-        bin_path = shutil.which(bin_name)
-        if bin_path:
-          util.add_path_if_unique(python_paths, bin_path)
-          if has_ldd:
-            add_shared_object_paths_from_bins(bin_path)
-
-      special_cases = [
-        # glibc only lazy loads this library when canceling threads which is why
-        # it doesn't show up in in the regular headers
-        '/lib/libgcc_s.so*',
-        '/lib64/libgcc_s.so*',
-        '/usr/lib/libgcc_s.so*',
-        '/usr/lib64/libgcc_s.so*',
-      ]
-      for pattern in special_cases:
-        for path in glob.iglob(pattern):
-          util.add_path_if_unique(python_paths, path)
-
-      parse_so_conf('/etc/ld.so.conf')
-      if os.path.exists('/etc/ld.so.cache'):
-        util.add_path_if_unique(python_paths, '/etc/ld.so.cache')
+    if not _python_paths_complete:
+      # A failed discovery leaves python_paths partly filled, it isn't marked
+      # complete so the next call discovers again
+      fingerprint = get_python_paths_fingerprint() if USE_PYTHON_PATHS_CACHE else None
+      cached = fingerprint and _load_cached_python_paths(fingerprint)
+      if cached:
+        python_paths.update(cached)
+      else:
+        module_dirs = _discover_python_paths()
+        if fingerprint:
+          _save_cached_python_paths(fingerprint, module_dirs)
+      _python_paths_complete = True
 
     return list(python_paths)
+
+def is_python_paths_ready():
+  return _python_paths_complete
+
+def warm_up_python_paths():
+  global _warm_up_future
+  with _warm_up_lock:
+    if _warm_up_future is None:
+      future = _warm_up_future = concurrent.futures.Future()
+      def worker():
+        if future.set_running_or_notify_cancel():
+          try:
+            future.set_result(get_python_paths())
+          except BaseException as ex:
+            future.set_exception(ex)
+            _reset_warm_up(future)
+      threading.Thread(target=worker, name='sandboxpy_warm_up', daemon=True).start()
+    return _warm_up_future
+
+def _reset_warm_up(future):
+  # Lets a later warm up retry after a failed discovery
+  global _warm_up_future
+  with _warm_up_lock:
+    if _warm_up_future is future:
+      _warm_up_future = None
+
+# Broad enough to run the interpreter without discovery but exposes far more than get_python_paths
+def get_fallback_python_paths():
+  paths = util.PathSet(['/bin/sh', '/etc/ld.so.cache', sys.executable])
+  candidates = ['/lib', '/lib64', '/usr/lib', '/usr/lib64', sys.prefix, sys.base_prefix, os.path.dirname(os.__file__)]
+  paths.update(filter(lambda i: i and os.path.exists(i), candidates + sys.path))
+  return list(paths)
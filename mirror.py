@@ -0,0 +1,183 @@
+import os, stat, json, errno, shutil, tempfile, threading, concurrent.futures
+from . import util
+
+try:
+  import fcntl
+except ModuleNotFoundError:
+  fcntl = None
+
+FICLONE = 0x40049409
+MANIFEST_SUFFIX = '.manifest.json'
+PARALLEL_THRESHOLD = 64
+
+# Hardlinks share the inode with the source so anything the sandbox writes to a
+# mirrored file would land in the original, only use them when that's acceptable
+USE_HARDLINKS = bool(os.environ.get('SANDBOXPY_MIRROR_HARDLINKS'))
+
+_lock = threading.Lock()
+
+def _copy_data(src_fd, dst_fd):
+  copy_file_range = getattr(os, 'copy_file_range', None)
+  if copy_file_range is not None:
+    try:
+      while copy_file_range(src_fd, dst_fd, 1 << 30):
+        pass
+      return
+    except OSError as ex:
+      if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        raise
+  # Both offsets have advanced by whatever copy_file_range managed so this picks up from there
+  with open(src_fd, 'rb', closefd=False) as fsrc, open(dst_fd, 'wb', closefd=False) as fdst:
+    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+def clone_file(src, dst):
+  if os.path.isdir(dst) and not os.path.islink(dst):
+    shutil.rmtree(dst)
+  # Files are replaced atomically so a concurrent run never sees a partial copy
+  tmp = '{}.{}.{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+  try:
+    if USE_HARDLINKS:
+      try:
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+        return
+      except OSError:
+        pass
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+      try:
+        if fcntl is None:
+          raise OSError(errno.EOPNOTSUPP, 'FICLONE is not available')
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+      except OSError:
+        _copy_data(fsrc.fileno(), fdst.fileno())
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dst)
+  except BaseException:
+    try: os.remove(tmp)
+    except OSError: pass
+    raise
+
+def _ensure_dir(path):
+  # A symlink left in place of a directory would have copies written through it
+  if os.path.islink(path):
+    os.remove(path)
+  try:
+    os.makedirs(path, exist_ok=True)
+  except FileExistsError:
+    os.remove(path)
+    os.makedirs(path, exist_ok=True)
+
+def _get_key(st):
+  return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _get_dst_key(dst):
+  # ctime is included since the sandbox can reset the mtime of a file it wrote
+  try:
+    st = os.lstat(dst)
+  except OSError:
+    return None
+  return _get_key(st) + [st.st_ctime_ns] if stat.S_ISREG(st.st_mode) else None
+
+def _scan(src, dst, manifest, seen, dirs, copies, visited):
+  st = os.stat(src)
+  if stat.S_ISDIR(st.st_mode):
+    if (st.st_dev, st.st_ino) in visited:
+      return
+    visited.add((st.st_dev, st.st_ino))
+    names = set()
+    dirs.append((dst, names))
+    with os.scandir(src) as it:
+      for entry in it:
+        try:
+          _scan(entry.path, os.path.join(dst, entry.name), manifest, seen, dirs, copies, visited)
+          names.add(entry.name)
+        except FileNotFoundError:
+          pass
+  elif stat.S_ISREG(st.st_mode):
+    # Mirrors are writable by the sandbox, so the copy is checked against
+    # what was left there last time as well as the source
+    key = _get_key(st)
+    entry = manifest.get(dst)
+    dst_key = _get_dst_key(dst)
+    if isinstance(entry, list) and len(entry) == 2 and entry == [key, dst_key]:
+      seen[dst] = entry
+    else:
+      seen[dst] = [key, None]
+      copies.append((src, dst))
+
+def _remove_extra_entries(dst, names):
+  # Anything the sandbox added to a mirrored directory is dropped, temporary
+  # files of copies in progress are left alone
+  try:
+    existing = os.listdir(dst)
+  except OSError:
+    return
+  for name in existing:
+    if name in names or name.endswith('.tmp'):
+      continue
+    path = os.path.join(dst, name)
+    try:
+      if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+    except OSError:
+      pass
+
+def _load_manifest(path):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def _save_manifest(path, manifest):
+  fd, tmp = tempfile.mkstemp(prefix='.manifest.', dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      json.dump(manifest, f)
+    os.replace(tmp, path)
+  except OSError:
+    try: os.remove(tmp)
+    except OSError: pass
+
+def mirror_paths(paths, md):
+  # Mirrors each path into md and returns {path: mirrored path}, only copying
+  # files whose size, mtime or inode changed since the last mirror into md,
+  # on either side
+  mp = {}
+  manifest_path = md + MANIFEST_SUFFIX
+  with _lock:
+    manifest = _load_manifest(manifest_path)
+    seen, dirs, copies, visited = {}, [], [], set()
+    for path in paths:
+      _, _, tail = util.split_root(os.path.abspath(path))
+      mpath = os.path.join(md, tail)
+      try:
+        dirs.append((os.path.dirname(mpath), None))
+        _scan(path, mpath, manifest, seen, dirs, copies, visited)
+        mp[path] = mpath
+      except FileNotFoundError:
+        pass
+    for d, names in dirs:
+      _ensure_dir(d)
+      if names is not None:
+        _remove_extra_entries(d, names)
+    for dst in manifest.keys() - seen.keys():
+      try: os.remove(dst)
+      except OSError: pass
+    def copy(item):
+      try:
+        clone_file(*item)
+        seen[item[1]][1] = _get_dst_key(item[1])
+      except FileNotFoundError:
+        seen.pop(item[1], None)
+    if len(copies) >= PARALLEL_THRESHOLD:
+      with concurrent.futures.ThreadPoolExecutor(min(32, (os.cpu_count() or 1) * 4)) as executor:
+        list(executor.map(copy, copies))
+    else:
+      for item in copies:
+        copy(item)
+    if seen != manifest:
+      _save_manifest(manifest_path, seen)
+  return mp
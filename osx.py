@@ -1,7 +1,7 @@
-import sys, os, tempfile
-from . import util
+import sys, os, tempfile, subprocess
+from . import util, instrumentation, streaming
 
-class SandboxedProcess(subprocess.Popen):
+class SandboxedProcess(streaming.StreamingProcess, instrumentation.TracedProcess, subprocess.Popen):
   pass
 
 def _fix_path(path):
@@ -25,19 +25,20 @@ def run(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensure_exi
     profile += '(regex "^' + _fix_path(path) + '")'
   profile += ')'
   scmd = ['sandbox-exec', '-p', profile]
-  proc = SandboxedProcess(
-           scmd + cmd,
-           stdin = subprocess.PIPE,
-           stdout = subprocess.PIPE,
-           stderr = subprocess.PIPE,
-           env=env,
-           cwd=cwd,
-         )
+  with instrumentation.launch(id, 'sandbox-exec'):
+    with instrumentation.phase('spawn'):
+      proc = SandboxedProcess(
+               scmd + cmd,
+               stdin = subprocess.PIPE,
+               stdout = subprocess.PIPE,
+               stderr = subprocess.PIPE,
+               env=env,
+               cwd=cwd,
+             )
+    instrumentation.track_process(proc)
   proc.dir_keep_alive_handles = dir_keep_alive_handles
   return proc
 
 def get_python_paths():
-  paths = set()
-  for path in [os.path.dirname(sys.executable), os.path.dirname(os.__file__)]:
-    util.add_path_if_unique(paths, path)
+  paths = util.PathSet([os.path.dirname(sys.executable), os.path.dirname(os.__file__)])
   return list(paths)
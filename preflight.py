@@ -1,15 +1,61 @@
-import os, sys, platform, errno, pdb
+import os, sys, json, stat, time, types, ctypes, hashlib, platform, tempfile, errno, pdb, collections
 
-STRICT_SYSCALL_WHITELIST = ['openat', 'read', 'write', 'fstat', 'pwrite64', 'pread64', 'fsync', 'fdatasync', 'close', 'lseek', 'exit', 'exit_group', 'brk', 'mmap', 'mprotect', 'poll', 'select', 'clock_nanosleep', 'nanosleep', 'fork', 'clone', 'getrandom', 'futex']
+# Filters check syscalls in whitelist order so the hottest ones come first
+STRICT_SYSCALL_WHITELIST = ['read', 'write', 'futex', 'pread64', 'pwrite64', 'lseek', 'fstat', 'openat', 'close', 'mmap', 'mprotect', 'brk', 'poll', 'select', 'clock_nanosleep', 'nanosleep', 'getrandom', 'fsync', 'fdatasync', 'clone', 'fork', 'exit', 'exit_group']
 
 DEFAULT_SYSCALL_WHITELIST = STRICT_SYSCALL_WHITELIST + ['open', 'openat', 'stat', 'lstat', 'getdents', 'getdents64', 'rename', 'unlink', 'unlinkat', 'mkdir', 'rmdir', 'chdir', 'fchdir', 'getcwd', 'access', 'fcntl', 'execve', 'uname', 'pipe', 'pipe2', 'dup', 'dup2', 'dup3', 'set_tid_address', 'set_robust_list', 'sigaction', 'rt_sigaction', 'seccomp']
 
 PATH_EXCEPTIONS = []
 
+# How far strip_paths_from_modules() follows references, each module is depth 0
+# and the objects its attributes refer to are depth 1
+STRIP_PATHS_MAX_DEPTH = int(os.environ.get('SANDBOXPY_STRIP_PATHS_DEPTH', 2))
+
+# Types which can't refer to a path and are never walked, modules are walked
+# from sys.modules instead of wherever they're first referenced
+SAFE_TYPES = frozenset((type(None), bool, int, float, complex, range, slice, type(Ellipsis), type(NotImplemented),
+                        types.CodeType, types.BuiltinFunctionType, types.WrapperDescriptorType,
+                        types.MethodWrapperType, types.MethodDescriptorType, types.ClassMethodDescriptorType,
+                        types.GetSetDescriptorType, types.MemberDescriptorType, types.ModuleType))
+
+strip_stats = {'objects': 0, 'paths': 0, 'seconds': 0.0}
+
 # TODO
 USE_SECCOMP = os.environ.get('SANDBOXPY_SECCOMP')
 
-def enable_seccomp(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST):
+# Whitelists are compiled to BPF once per architecture and kernel and the
+# sandbox loads the cached program directly, without libseccomp
+SECCOMP_CACHE_DIR = os.environ.get('SANDBOXPY_SECCOMP_CACHE_DIR')
+
+# Has libseccomp build a binary search tree instead of checking syscalls in order
+SECCOMP_BINARY_TREE = bool(os.environ.get('SANDBOXPY_SECCOMP_BINARY_TREE'))
+
+# Kept in generated whitelists even if a profile never saw them
+REQUIRED_SYSCALLS = ['exit', 'exit_group', 'rt_sigreturn']
+
+PR_SET_NO_NEW_PRIVS = 38
+PR_SET_SECCOMP = 22
+SECCOMP_MODE_FILTER = 2
+BPF_INSTRUCTION_SIZE = 8
+
+class _SockFprog(ctypes.Structure):
+  _fields_ = [('len', ctypes.c_ushort), ('filter', ctypes.c_void_p)]
+
+
+def get_seccomp_cache_dir():
+  if SECCOMP_CACHE_DIR:
+    return SECCOMP_CACHE_DIR
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'sandboxpy', 'seccomp')
+
+
+def get_seccomp_cache_path(syscall_whitelist, binary_tree=SECCOMP_BINARY_TREE):
+  # Order is part of the key since it's the order syscalls are checked in
+  key = json.dumps([list(syscall_whitelist), binary_tree, platform.machine(), platform.release()])
+  return os.path.join(get_seccomp_cache_dir(), hashlib.sha256(key.encode()).hexdigest() + '.bpf')
+
+
+def compile_seccomp(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST, binary_tree=SECCOMP_BINARY_TREE):
   try:
     import seccomp
   except ImportError:
@@ -18,10 +64,93 @@ def enable_seccomp(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST):
   filter = seccomp.SyscallFilter(seccomp.ERRNO(errno.EACCES))
   if platform.machine() in ('AMD64', 'x86_64'):
     filter.add_arch(seccomp.Arch.X86)
-  for i in syscall_whitelist:
+  if binary_tree:
+    # Needs libseccomp 2.5, older versions keep the priority order below
+    try:
+      filter.set_attr(seccomp.Attr.CTL_OPTIMIZE, 2)
+    except (AttributeError, OSError, RuntimeError):
+      pass
+  for n, i in enumerate(syscall_whitelist):
     filter.add_rule(seccomp.ALLOW, i)
-  filter.load()
-  return filter
+    filter.syscall_priority(i, max(255 - n, 0))
+  with tempfile.TemporaryFile() as f:
+    filter.export_bpf(f)
+    f.seek(0)
+    return f.read()
+
+
+def _read_cached_bpf(path):
+  # The cache is only trusted if it and its directory belong to this user or
+  # root and nobody else can write to them
+  with open(path, 'rb') as f:
+    for st in (os.fstat(f.fileno()), os.stat(os.path.dirname(path))):
+      if st.st_uid not in (os.getuid(), 0) or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(errno.EPERM, 'Untrusted seccomp cache', path)
+    return f.read()
+
+
+def precompile_seccomp(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST, binary_tree=SECCOMP_BINARY_TREE):
+  # Compiles and caches the filter ahead of time, returns the cached file's path
+  path = get_seccomp_cache_path(syscall_whitelist, binary_tree)
+  try:
+    _read_cached_bpf(path)
+    return path
+  except OSError:
+    pass
+  bpf = compile_seccomp(syscall_whitelist, binary_tree)
+  os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(bpf)
+    os.replace(tmp, path)
+  except OSError:
+    os.remove(tmp)
+    raise
+  _read_cached_bpf(path)
+  return path
+
+
+def precompile_seccomp_filters(binary_tree=SECCOMP_BINARY_TREE):
+  # The filters the safeguards load, for sandboxes which can't compile them
+  return [precompile_seccomp(i, binary_tree) for i in (DEFAULT_SYSCALL_WHITELIST, STRICT_SYSCALL_WHITELIST)]
+
+
+def get_seccomp_bpf(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST, binary_tree=SECCOMP_BINARY_TREE):
+  try:
+    return _read_cached_bpf(get_seccomp_cache_path(syscall_whitelist, binary_tree))
+  except OSError:
+    pass
+  try:
+    return _read_cached_bpf(precompile_seccomp(syscall_whitelist, binary_tree))
+  except OSError:
+    # The cache isn't writable in most sandboxes
+    return compile_seccomp(syscall_whitelist, binary_tree)
+
+
+def load_seccomp_bpf(bpf):
+  if not bpf or len(bpf) % BPF_INSTRUCTION_SIZE:
+    raise ValueError('Invalid BPF program')
+  libc = ctypes.CDLL(None, use_errno=True)
+  buf = ctypes.create_string_buffer(bpf, len(bpf))
+  prog = _SockFprog(len(bpf) // BPF_INSTRUCTION_SIZE, ctypes.cast(buf, ctypes.c_void_p))
+  if (libc.prctl(PR_SET_NO_NEW_PRIVS, ctypes.c_ulong(1), ctypes.c_ulong(0), ctypes.c_ulong(0), ctypes.c_ulong(0)) != 0 or
+      libc.prctl(PR_SET_SECCOMP, ctypes.c_ulong(SECCOMP_MODE_FILTER), ctypes.byref(prog), ctypes.c_ulong(0), ctypes.c_ulong(0)) != 0):
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+
+def enable_seccomp(syscall_whitelist=DEFAULT_SYSCALL_WHITELIST, binary_tree=SECCOMP_BINARY_TREE):
+  bpf = get_seccomp_bpf(syscall_whitelist, binary_tree)
+  load_seccomp_bpf(bpf)
+  return bpf
+
+
+def get_minimal_whitelist(syscall_counts, required=REQUIRED_SYSCALLS):
+  # Builds a whitelist of only the syscalls a profiled workload made, see
+  # linux.profile_syscalls(), most frequent first
+  whitelist = sorted(syscall_counts, key=lambda i: (-syscall_counts[i], i))
+  return whitelist + [i for i in required if i not in syscall_counts]
 
 
 def enable_default_seccomp():
@@ -42,43 +171,156 @@ def clear_environment_variables():
 
 
 def is_potential_path(path):
-  try:
-    path = path.decode()
-  except (AttributeError, TypeError, UnicodeDecodeError, OSError):
-    pass
   if not type(path) is str:
-    return False
+    try:
+      path = path.decode()
+    except (AttributeError, TypeError, UnicodeDecodeError, OSError):
+      return False
+    if not type(path) is str:
+      return False
   return (':\\' in path or path.startswith('/') or path.startswith('\\\\')) and path not in PATH_EXCEPTIONS
 
 
-def remove_potential_paths_from_object(obj):
-  for a in dir(obj):
-    try:
-      v = getattr(obj, a)
-    except AttributeError:
-      continue # Ignore __abstractmethods__ et al
-    try:
-      if is_potential_path(v):
-        setattr(obj, a, '' if type(v) is str else b'')
-      elif hasattr(v, 'clear'):
-        try:
-          if any(map(is_potential_path, v)):
-            v.clear()
-        except TypeError:
-          pass
-    except OSError:
-      pass
+def _empty(value):
+  # What a value that is or holds a path which can't be removed is replaced by
+  if isinstance(value, str):
+    return ''
+  if isinstance(value, bytes):
+    return b''
+  if type(value) in (tuple, frozenset):
+    return type(value)()
+  return None
 
 
-def strip_paths_from_modules():
-  for m in sys.modules.values():
-    remove_potential_paths_from_object(m)
-    for a in dir(m):
+def _get_attributes(obj):
+  try:
+    return list(vars(obj).items())
+  except TypeError:
+    pass
+  # Only slots are read from objects without a __dict__, other attributes of
+  # builtin types are computed or read only
+  attrs = []
+  for cls in type(obj).__mro__:
+    slots = cls.__dict__.get('__slots__', ())
+    for name in (slots,) if isinstance(slots, str) else slots:
       try:
-        remove_potential_paths_from_object(getattr(m,a))
+        attrs.append((name, getattr(obj, name)))
       except AttributeError:
-        # Remove the entire object if it contains any read-only paths
-        setattr(m, a, None)
+        pass
+  return attrs
+
+
+class _PathStripper(object):
+  def __init__(self, max_depth):
+    self.max_depth = max_depth
+    self.seen = {}
+    self.objects = 0
+    self.paths = 0
+
+  def _holds_path(self, value, depth):
+    # True if value is a path or holds one which couldn't be removed
+    if isinstance(value, (str, bytes)):
+      if is_potential_path(value):
+        self.paths += 1
+        return True
+      return False
+    if type(value) in SAFE_TYPES:
+      return False
+    if depth >= self.max_depth:
+      return self._leaf_holds_path(value)
+    return not self.walk(value, depth)
+
+  def _leaf_holds_path(self, value):
+    # Containers at the depth limit still have their strings checked, without
+    # following anything else, like the old scrubber which cleared them
+    if isinstance(value, dict):
+      try:
+        items = list(value.items())
+      except RuntimeError:
+        return False
+      if any(isinstance(i, (str, bytes)) and is_potential_path(i) for kv in items for i in kv):
+        self.paths += 1
+        value.clear()
+      return False
+    if not isinstance(value, (list, set, collections.deque, tuple, frozenset)):
+      return False
+    try:
+      values = list(value)
+    except RuntimeError:
+      return False
+    if not any(isinstance(i, (str, bytes)) and is_potential_path(i) for i in values):
+      return False
+    self.paths += 1
+    if isinstance(value, (tuple, frozenset)):
+      return True
+    value.clear()
+    return False
+
+  def walk(self, obj, depth=0):
+    # Removes the paths obj refers to, returns False if some couldn't be
+    key = id(obj)
+    if self.seen.get(key, self.max_depth) <= depth:
+      return True
+    self.seen[key] = depth
+    self.objects += 1
+    if isinstance(obj, dict):
+      return self._walk_dict(obj, depth)
+    if isinstance(obj, (list, set, collections.deque, tuple, frozenset)):
+      return self._walk_items(obj, depth)
+    ok = True
+    for name, value in _get_attributes(obj):
+      if self._holds_path(value, depth + 1):
+        try:
+          setattr(obj, name, _empty(value))
+        except (AttributeError, TypeError):
+          ok = False
+    return ok
+
+  def _walk_dict(self, d, depth):
+    # Values are treated like attributes while a path in the keys clears the dict
+    try:
+      items = list(d.items())
+    except RuntimeError:
+      return True # Changed by another thread
+    for k, v in items:
+      if isinstance(k, (str, bytes)) and is_potential_path(k):
+        self.paths += 1
+        d.clear()
+        return True
+      if self._holds_path(v, depth + 1):
+        d[k] = _empty(v)
+    return True
+
+  def _walk_items(self, items, depth):
+    # Containers are cleared entirely if any of their items is a path
+    try:
+      values = list(items)
+    except RuntimeError:
+      return True
+    for v in values:
+      if self._holds_path(v, depth + 1):
+        if isinstance(items, (tuple, frozenset)):
+          return False
+        items.clear()
+        return True
+    return True
+
+
+def remove_potential_paths_from_object(obj, max_depth=2):
+  if not _PathStripper(max_depth).walk(obj):
+    raise AttributeError('Unable to remove every path from ' + repr(obj))
+
+
+def strip_paths_from_modules(max_depth=STRIP_PATHS_MAX_DEPTH):
+  # Attributes holding paths which can't be removed are set to None, returns
+  # how many objects were visited, paths were found and seconds it took
+  start = time.perf_counter()
+  stripper = _PathStripper(max_depth)
+  for m in list(sys.modules.values()):
+    if m is not None:
+      stripper.walk(m)
+  strip_stats.update(objects=stripper.objects, paths=stripper.paths, seconds=time.perf_counter() - start)
+  return dict(strip_stats)
 
 
 def clear_handles():
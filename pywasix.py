@@ -1,9 +1,184 @@
+import os, copy, ctypes, functools, subprocess
 import pywasm
-import warnings
-
-def run(cmd, **kwargs):
-  warnings.warn('pywasm support is incomplete and will likely not work')
-  # TODO implement and import wasix functions w/ path and network filtering
-  runtime = pywasm.core.Runtime()
-  module = runtime.instance_from_file(cmd[0])
-  return runtime.invocate(module, '_start', [])
+from . import util, inprocess, instrumentation
+
+# Runs WASI preview1 modules inside this process on pywasm's interpreter.
+# Guest paths are the host paths, every path a syscall touches is resolved on
+# the host and checked against the readable and writable paths so that
+# symlinks and .. can't be used to reach anything else.
+
+# Rights which let an fd change the file it refers to
+WRITE_RIGHTS = (1 << 0) | (1 << 6) | (1 << 8) | (1 << 19) | (1 << 20) | (1 << 22) | (1 << 23)
+
+# (fd, path pointer, path length, lookup flags, needs write access) for each path argument
+PATH_ARGS = {
+  'path_create_directory': [(0, 1, 2, None, True)],
+  'path_filestat_get': [(0, 2, 3, 1, False)],
+  'path_filestat_set_times': [(0, 2, 3, 1, True)],
+  'path_link': [(0, 2, 3, 1, False), (4, 5, 6, None, True)],
+  'path_readlink': [(0, 1, 2, None, False)],
+  'path_remove_directory': [(0, 1, 2, None, True)],
+  'path_rename': [(0, 1, 2, None, True), (3, 4, 5, None, True)],
+  'path_symlink': [(2, 3, 4, None, True)],
+  'path_unlink_file': [(0, 1, 2, None, True)],
+}
+
+class Preview1(pywasm.wasi.Preview1):
+  def __init__(self, args, readable_paths, writable_paths, env):
+    self.readable = util.PathSet(os.path.realpath(i) for i in readable_paths + writable_paths)
+    self.writable = util.PathSet(os.path.realpath(i) for i in writable_paths)
+    # Preopens have to be directories so files are reached through their parent
+    dirs = util.PathSet()
+    for path in readable_paths + writable_paths:
+      path = os.path.abspath(path)
+      dirs.add(path if os.path.isdir(path) else os.path.dirname(path))
+    super().__init__(args, {i: i for i in dirs}, env)
+    for name, specs in PATH_ARGS.items():
+      setattr(self, name, self._filter_paths(getattr(self, name), specs))
+
+  def _resolve(self, m, fd, ptr, length, follow):
+    mems = m.store.mems[m.stack.frame[-1].module.mems[0]]
+    path = os.path.join(self.fd[fd].host_name, mems.get(ptr, length).decode(errors='surrogateescape'))
+    if follow:
+      return os.path.realpath(path)
+    # The last component isn't followed so only its parent has to be resolved
+    return os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+
+  def _is_allowed(self, path, write):
+    return (self.writable if write else self.readable).covers(path)
+
+  def _filter_paths(self, fn, specs):
+    @functools.wraps(fn)
+    def filtered(m, args):
+      for fd, ptr, length, flags, write in specs:
+        if self.help_badf(args[fd]):
+          return [self.ERRNO_BADF]
+        follow = flags is not None and args[flags] & self.LOOKUPFLAGS_SYMLINK_FOLLOW
+        if not self._is_allowed(self._resolve(m, args[fd], args[ptr], args[length], follow), write):
+          return [self.ERRNO_ACCES]
+      return fn(m, args)
+    return filtered
+
+  def path_open(self, m, args):
+    if self.help_badf(args[0]):
+      return [self.ERRNO_BADF]
+    path = self._resolve(m, args[0], args[2], args[3], args[1] & self.LOOKUPFLAGS_SYMLINK_FOLLOW)
+    if not self._is_allowed(path, False):
+      return [self.ERRNO_ACCES]
+    if not self._is_allowed(path, True):
+      if args[4] & (self.OFLAGS_CREAT | self.OFLAGS_TRUNC) or args[5] & self.RIGHTS_FD_WRITE:
+        return [self.ERRNO_ACCES]
+      # Read only fds still need to lose the rights to resize files or change their times
+      args = list(args)
+      args[5] &= ~WRITE_RIGHTS
+      args[6] &= ~WRITE_RIGHTS
+    return super().path_open(m, args)
+
+  def _is_visible(self, path):
+    # Entries which are readable or lead to something readable
+    return self.readable.covers(path) or any(util.path_contains_or_is_in_path(path, i) for i in self.readable)
+
+  def fd_readdir(self, m, args):
+    # Same as pywasm's except that directories preopened only to reach the
+    # files in them list just the entries which were granted
+    if self.help_badf(args[0]):
+      return [self.ERRNO_BADF]
+    if self.help_perm(args[0], self.RIGHTS_FD_READDIR):
+      return [self.ERRNO_NOTCAPABLE]
+    mems = m.store.mems[m.stack.frame[-1].module.mems[0]]
+    file = self.fd[args[0]]
+    dirent = args[1]
+    bufend = dirent + args[2]
+    cookie = args[3]
+    names = sorted(os.listdir(file.host_fd))
+    host_dir = os.path.realpath(file.host_name)
+    if not self.readable.covers(host_dir):
+      names = [i for i in names if self._is_visible(os.path.join(host_dir, i))]
+    result = ['.', '..', *names]
+    for name in result[cookie:]:
+      if dirent + 24 > bufend:
+        break
+      info = os.stat(os.path.normpath(os.path.join(file.host_name, name)))
+      mems.put_u64(dirent, cookie + 1)
+      mems.put_u64(dirent + 8, info.st_ino)
+      mems.put_u32(dirent + 16, len(name))
+      mems.put_u8(dirent + 20, self.help_wasm_type(info))
+      dirent += 24
+      if dirent + len(name) > bufend:
+        break
+      mems.put(dirent, bytearray(name.encode()))
+      dirent += len(name)
+      cookie += 1
+    mems.put_u32(args[4], dirent - args[1] if cookie >= len(result) else args[2])
+    return [self.ERRNO_SUCCESS]
+
+  def random_get(self, m, args):
+    mems = m.store.mems[m.stack.frame[-1].module.mems[0]]
+    mems.put(args[0], bytearray(os.urandom(args[1])))
+    return [self.ERRNO_SUCCESS]
+
+  def set_stdio(self, stdin, stdout, stderr):
+    for fd, host_fd in zip((self.FD_STDIN, self.FD_STDOUT, self.FD_STDERR), (stdin, stdout, stderr)):
+      self.fd[fd].host_fd = host_fd
+
+
+@functools.lru_cache(maxsize=16)
+def _load_module(path, size, mtime):
+  # Parsing is slow in pure python so the description is shared between runs
+  with open(path, 'rb') as f:
+    return pywasm.core.ModuleDesc.from_reader(f)
+
+def load_module(path):
+  st = os.stat(path)
+  desc = _load_module(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+  # Instances use the data segments' bytes directly and data.drop clears them,
+  # so every run gets its own copy of those
+  module = copy.copy(desc)
+  module.data = [pywasm.core.DataDesc(i.kind, i.midx, i.offset, bytearray(i.init)) for i in desc.data]
+  return module
+
+
+class WasiProcess(inprocess.InProcess):
+  def __init__(self, args, wasi, module, stdin, stdout, stderr):
+    super().__init__(args, stdin, stdout, stderr)
+    self._wasi = wasi
+    self._module = module
+    wasi.set_stdio(*self.stdio_fds)
+
+  def _execute(self):
+    runtime = pywasm.core.Runtime()
+    self._wasi.bind(runtime)
+    return self._wasi.main(runtime, runtime.instance(self._module))
+
+  def _interrupt(self):
+    # pywasm is pure python so an async exception stops it at the next bytecode
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._thread_ident), ctypes.py_object(inprocess.Killed))
+
+
+def run(cmd,
+        id,
+        readable_paths=[],
+        writable_paths=[],
+        writable_paths_ensure_exists=[],
+        env=None,
+        cwd=None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs):
+  with instrumentation.launch(id, 'pywasix'):
+    with instrumentation.phase('build_command'):
+      dir_keep_alive_handles = []
+      for path in writable_paths_ensure_exists:
+        dir_keep_alive_handles.append(util.ensure_dir_exists_and_get_keep_alive_handle(path))
+      readable_paths = [i for i in readable_paths if os.path.exists(i)]
+      writable_paths = [i for i in list(writable_paths) + list(writable_paths_ensure_exists) if os.path.exists(i)]
+      # The module itself is loaded by the host so it doesn't have to be readable
+      module = load_module(cmd[0])
+      wasi = Preview1(list(cmd), readable_paths, writable_paths, {} if env is None else dict(env))
+    with instrumentation.phase('spawn'):
+      proc = WasiProcess(cmd, wasi, module, stdin, stdout, stderr)
+      proc.start()
+    proc.dir_keep_alive_handles = dir_keep_alive_handles
+    instrumentation.track_process(proc)
+    return proc
@@ -0,0 +1,114 @@
+import os, time, tempfile, selectors, subprocess, collections
+from . import instrumentation
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+DEFAULT_TAIL_SIZE = 1 << 20
+
+class RingBuffer(object):
+  # Keeps only the last max_size bytes written to it
+  def __init__(self, max_size=DEFAULT_TAIL_SIZE):
+    self.max_size = max_size
+    self.size = 0
+    self._chunks = collections.deque()
+
+  def write(self, data):
+    if len(data) >= self.max_size:
+      self._chunks.clear()
+      data = data[-self.max_size:]
+      self.size = 0
+    self._chunks.append(data)
+    self.size += len(data)
+    while self.size > self.max_size:
+      extra = self.size - self.max_size
+      first = self._chunks[0]
+      if len(first) <= extra:
+        self._chunks.popleft()
+        self.size -= len(first)
+      else:
+        self._chunks[0] = first[extra:]
+        self.size -= extra
+
+  def getvalue(self):
+    return b''.join(self._chunks)
+
+
+class OutputStream(object):
+  def __init__(self,
+               proc,
+               lines=False,
+               tail_size=DEFAULT_TAIL_SIZE,
+               spill=False,
+               spill_dir=None,
+               chunk_size=DEFAULT_CHUNK_SIZE,
+               close_stdin=True,
+               timeout=None):
+    self.proc = proc
+    self.lines = lines
+    self.chunk_size = chunk_size
+    self.timeout = timeout
+    self.pipes = {name: pipe for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)) if pipe is not None}
+    if proc.stderr is not None and proc.stderr is proc.stdout:
+      del self.pipes['stderr']
+    self.tails = {name: RingBuffer(tail_size) for name in self.pipes}
+    self.spill_files = {}
+    if spill:
+      for name in self.pipes:
+        self.spill_files[name] = tempfile.NamedTemporaryFile(prefix='sandboxpy_'+name+'_', dir=spill_dir)
+    self.bytes_read = {name: 0 for name in self.pipes}
+    if close_stdin and proc.stdin is not None:
+      try:
+        proc.stdin.close()
+      except BrokenPipeError:
+        pass
+
+  def tail(self, name='stdout'):
+    return self.tails[name].getvalue()
+
+  def _record(self, name, data):
+    instrumentation.record_output(self.proc)
+    self.bytes_read[name] += len(data)
+    self.tails[name].write(data)
+    if name in self.spill_files:
+      self.spill_files[name].write(data)
+
+  def __iter__(self):
+    end = None if self.timeout is None else time.monotonic() + self.timeout
+    partial = {name: b'' for name in self.pipes}
+    with selectors.DefaultSelector() as selector:
+      for name, pipe in self.pipes.items():
+        selector.register(pipe.fileno(), selectors.EVENT_READ, name)
+      while selector.get_map():
+        remaining = None if end is None else end - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise subprocess.TimeoutExpired(self.proc.args, self.timeout)
+        for key, _ in selector.select(remaining):
+          name = key.data
+          data = os.read(key.fd, self.chunk_size)
+          if not data:
+            selector.unregister(key.fd)
+            self.pipes[name].close()
+            if partial[name]:
+              yield name, partial[name]
+            continue
+          self._record(name, data)
+          if not self.lines:
+            yield name, data
+            continue
+          data = partial[name] + data
+          *complete, partial[name] = data.split(b'\n')
+          for line in complete:
+            yield name, line + b'\n'
+          # Lines longer than the tail are passed on in pieces rather than buffered
+          if len(partial[name]) >= self.tails[name].max_size:
+            yield name, partial[name]
+            partial[name] = b''
+    for f in self.spill_files.values():
+      f.flush()
+      f.seek(0)
+    self.proc.wait(None if end is None else max(0, end - time.monotonic()))
+
+
+class StreamingProcess(object):
+  # Mixin for processes with stdout/stderr pipes which reads them with bounded memory
+  def stream(self, **kwargs):
+    return OutputStream(self, **kwargs)
@@ -0,0 +1,75 @@
+import sys, json, pickle, subprocess, pytest
+from .. import executor, executor_worker
+
+def _response(ok, value, *rest):
+  return json.dumps([ok, executor_worker.encode_value(value)] + list(rest)).encode()
+
+class _Exploit(object):
+  def __reduce__(self):
+    return (print, ('unpickled',))
+
+def test_decode_result():
+  value = {'a': [1, (2.0, b'x', 1j)], (None, True): {frozenset([1]), 'b'}}
+  assert executor.decode_response(_response(True, value, 10)) == (True, value, 10)
+
+def test_decode_builtin_exception():
+  ok, ex, rss = executor.decode_response(_response(False, ('ValueError', 'bad', 'Traceback ...'), 0))
+  assert not ok and type(ex) is ValueError and str(ex) == 'bad'
+  assert isinstance(ex.__cause__, executor.RemoteTraceback)
+
+def test_decode_other_exception():
+  for name in ('mymodule.Error', 'SystemExit', 'KeyboardInterrupt', '__import__'):
+    _, ex, _ = executor.decode_response(_response(False, (name, 'bad', ''), 0))
+    assert type(ex) is executor.RemoteError and ex.type_name == name
+
+def test_pickles_are_rejected(capsys):
+  with pytest.raises(executor.InvalidResponse):
+    executor.decode_response(pickle.dumps((True, _Exploit(), None, 0)))
+  assert 'unpickled' not in capsys.readouterr().out
+
+def test_unknown_tags_are_rejected():
+  for value in ({'code': 'x'}, {'tuple': [1], 'list': []}, {'dict': [[[1], 2]]}, {'bytes': '!'}, {'complex': [True, 1]}):
+    with pytest.raises(executor.InvalidResponse):
+      executor.decode_response(json.dumps([True, value, 0]).encode())
+
+def test_malformed_responses_are_rejected():
+  for data in (b'', b'\xff\xff', b'[' * 100000, _response(True, 1), _response(1, 1, 1), _response(True, 1, 'x'),
+               _response(False, ('ValueError', 1, ''), 0), _response(False, 'ValueError', 0)):
+    with pytest.raises(executor.InvalidResponse):
+      executor.decode_response(data)
+
+def _recursive():
+  value = []
+  value.append(value)
+  return value
+
+def _call(worker, fn, *args):
+  return executor.decode_response(worker.call(pickle.dumps((fn, args, {}))))
+
+def test_worker_protocol():
+  # The worker script on its own, without a sandbox around it
+  proc = subprocess.Popen([sys.executable, executor.WORKER_PATH, json.dumps({'path': sys.path})],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  worker = executor._Worker(proc)
+  try:
+    assert _call(worker, divmod, 7, 2)[:2] == (True, (3, 1))
+    ok, ex, _ = _call(worker, int, 'x')
+    assert not ok and type(ex) is ValueError and 'int(' in str(ex.__cause__)
+    ok, ex, _ = _call(worker, object)
+    assert not ok and type(ex) is TypeError
+    ok, ex, _ = _call(worker, _recursive)
+    assert not ok and type(ex) is ValueError
+    assert _call(worker, print, 'not part of the protocol')[:2] == (True, None)
+  finally:
+    worker.close()
+
+def test_oversized_response(monkeypatch):
+  monkeypatch.setattr(executor, 'MAX_RESPONSE_SIZE', 16)
+  proc = subprocess.Popen([sys.executable, executor.WORKER_PATH, json.dumps({'path': sys.path})],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  worker = executor._Worker(proc)
+  try:
+    with pytest.raises(executor.InvalidResponse):
+      _call(worker, bytes, 64)
+  finally:
+    worker.close()
@@ -0,0 +1,70 @@
+import sys, time, threading, subprocess
+from .. import instrumentation
+
+def _record(events):
+  listener = lambda event: events.append(event)
+  instrumentation.add_listener(listener)
+  return listener
+
+def test_no_first_output_without_output():
+  events = []
+  listener = _record(events)
+  try:
+    with instrumentation.launch('test', 'none'):
+      proc = subprocess.Popen([sys.executable, '-c', 'pass'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      instrumentation.track_process(proc)
+    time.sleep(0.5)
+    proc.communicate()
+  finally:
+    instrumentation.remove_listener(listener)
+  assert 'first_output' not in [i['phase'] for i in events]
+
+def test_first_output_recorded_once():
+  events = []
+  listener = _record(events)
+  try:
+    with instrumentation.launch('test', 'none'):
+      proc = subprocess.Popen([sys.executable, '-c', 'print(1)'], stdout=subprocess.PIPE)
+      instrumentation.track_process(proc)
+    instrumentation.record_output(proc)
+    instrumentation.record_output(proc)
+    proc.communicate()
+  finally:
+    instrumentation.remove_listener(listener)
+  assert [i['phase'] for i in events].count('first_output') == 1
+
+def test_first_output_watched_by_one_thread():
+  events = []
+  listener = _record(events)
+  try:
+    procs = []
+    for i in range(4):
+      with instrumentation.launch('test{}'.format(i), 'none'):
+        proc = subprocess.Popen([sys.executable, '-c', 'import time;print(1,flush=True);time.sleep(1)'], stdout=subprocess.PIPE)
+        instrumentation.track_process(proc)
+        procs.append(proc)
+    watchers = [i for i in threading.enumerate() if i.name == 'sandboxpy_first_output']
+    end = time.monotonic() + 5
+    while [i['phase'] for i in events].count('first_output') < 4 and time.monotonic() < end:
+      time.sleep(0.05)
+    for proc in procs:
+      proc.communicate()
+  finally:
+    instrumentation.remove_listener(listener)
+  assert len(watchers) == 1
+  assert [i['phase'] for i in events].count('first_output') == 4
+
+def test_nested_launches_are_one_launch():
+  events = []
+  listener = _record(events)
+  try:
+    with instrumentation.launch('test', 'outer'):
+      with instrumentation.phase('get_python_paths'):
+        pass
+      with instrumentation.launch('test', 'inner'):
+        with instrumentation.phase('spawn'):
+          pass
+  finally:
+    instrumentation.remove_listener(listener)
+  assert len({i['launch'] for i in events}) == 1
+  assert events[-1]['backend'] == 'inner'
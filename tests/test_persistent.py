@@ -0,0 +1,51 @@
+import shutil, platform, pytest
+
+if platform.system() != 'Linux' or not shutil.which('bwrap'):
+  pytest.skip('persistent sandboxes need bwrap', allow_module_level=True)
+
+from .. import linux, zygote
+
+ID = 'sandboxpy_test_persistent'
+
+@pytest.fixture(autouse=True)
+def teardown():
+  yield
+  linux.delete_all_sandboxes()
+
+def _run(cmd, **kwargs):
+  proc = linux.run(cmd, ID, persistent=True, expose_python_paths=True, **kwargs)
+  stdout, _ = proc.communicate(timeout=60)
+  return proc, stdout
+
+def test_requires_opt_in():
+  with pytest.raises(ValueError):
+    linux.run(['true'], ID, persistent=True)
+
+def test_runs_reuse_the_sandbox():
+  _, first = _run(['sh', '-c', 'echo $PPID'])
+  _, second = _run(['sh', '-c', 'echo $PPID'])
+  assert first == second
+  assert len(zygote._zygotes) == 1
+
+def test_exit_codes_and_stdin():
+  proc = linux.run(['sh', '-c', 'cat; exit 3'], ID, persistent=True, expose_python_paths=True)
+  assert proc.communicate(b'input', timeout=60) == (b'input', b'')
+  assert proc.returncode == 3
+  proc, _ = _run(['sandboxpy-missing-command'])
+  assert proc.returncode == 127
+
+def test_limits_apply_to_each_run():
+  limited, stdout = _run(['sh', '-c', 'ulimit -v'], memory_max=256 << 20)
+  assert limited.cgroup is not None or stdout == b'262144\n'
+  _, stdout = _run(['sh', '-c', 'ulimit -v'])
+  assert stdout == b'unlimited\n'
+  assert len(zygote._zygotes) == 1
+
+def test_delete_all_sandboxes():
+  _run(['true'])
+  proc = list(zygote._zygotes.values())[0].proc
+  linux.delete_all_sandboxes()
+  assert not zygote._zygotes
+  assert proc.poll() is not None
+  assert _run(['true'])[0].returncode == 0
+  assert len(zygote._zygotes) == 1
@@ -0,0 +1,45 @@
+import os, types, pytest
+from .. import preflight
+
+def _module():
+  module = types.ModuleType('sandboxpy_test_module')
+  class Holder(object):
+    cache = {'/etc/secret': 1}
+    values = {'key': '/etc/secret3'}
+    lst = ['/etc/secret2']
+    names = ('/etc/secret4',)
+    plain = ['a', 'b']
+  module.Holder = Holder
+  module.path = '/etc/secret5'
+  module.paths = ['/etc/secret6']
+  return module
+
+def test_strips_module_level_paths():
+  module = _module()
+  preflight.remove_potential_paths_from_object(module)
+  assert module.path == ''
+  assert module.paths == []
+
+def test_strips_containers_at_depth_limit():
+  module = _module()
+  preflight.remove_potential_paths_from_object(module)
+  assert module.Holder.cache == {}
+  assert module.Holder.values == {}
+  assert module.Holder.lst == []
+  assert module.Holder.names == ()
+  assert module.Holder.plain == ['a', 'b']
+
+def test_is_potential_path():
+  assert preflight.is_potential_path('/usr/lib')
+  assert preflight.is_potential_path(b'C:\\Windows')
+  assert not preflight.is_potential_path('usr/lib')
+  assert not preflight.is_potential_path(1)
+
+def test_untrusted_seccomp_cache_is_rejected(tmp_path):
+  path = tmp_path / 'filter.bpf'
+  path.write_bytes(b'\0' * 8)
+  os.chmod(tmp_path, 0o700)
+  assert preflight._read_cached_bpf(str(path)) == b'\0' * 8
+  os.chmod(tmp_path, 0o777)
+  with pytest.raises(PermissionError):
+    preflight._read_cached_bpf(str(path))
@@ -0,0 +1,69 @@
+import sys, pytest
+
+pywasm = pytest.importorskip('pywasm')
+
+from .. import pywasix
+
+def _vec(items):
+  return bytes([len(items)]) + b''.join(items)
+
+def _name(s):
+  return bytes([len(s)]) + s.encode()
+
+def _section(id, items):
+  body = _vec(items)
+  return bytes([id, len(body)]) + body
+
+def _module(imports, code, data):
+  # A module with one memory whose _start runs code, every import has its own type
+  types = [b'\x60' + _vec([bytes([i]) for i in params]) + b'\x01\x7f' for _, params in imports] + [b'\x60\x00\x00']
+  body = b'\x00' + code + b'\x0b'
+  return (b'\x00asm\x01\x00\x00\x00' +
+          _section(1, types) +
+          _section(2, [_name('wasi_snapshot_preview1') + _name(name) + bytes([0, i]) for i, (name, _) in enumerate(imports)]) +
+          _section(3, [bytes([len(imports)])]) +
+          _section(5, [b'\x00\x01']) +
+          _section(7, [_name('memory') + b'\x02\x00', _name('_start') + bytes([0, len(imports)])]) +
+          _section(10, [bytes([len(body)]) + body]) +
+          _section(11, [b'\x00\x41\x00\x0b' + bytes([len(data)]) + data]))
+
+FD_WRITE = ('fd_write', [0x7f] * 4)
+FD_READDIR = ('fd_readdir', [0x7f, 0x7f, 0x7f, 0x7e, 0x7f])
+# fd_write(1, iovs=0, iovs_len=1, nwritten=8)
+WRITE_IOV = b'\x41\x01\x41\x00\x41\x01\x41\x08\x10\x00\x1a'
+
+@pytest.fixture(autouse=True)
+def real_stdio(monkeypatch):
+  # pywasm looks up the stdio fds when it's set up which pytest's capturing replaces
+  for name in ('stdin', 'stdout', 'stderr'):
+    monkeypatch.setattr(sys, name, getattr(sys, '__' + name + '__'))
+
+def _write(tmp_path, module):
+  path = tmp_path / 'module.wasm'
+  path.write_bytes(module)
+  return str(path)
+
+def _run(path, readable_paths=[]):
+  proc = pywasix.run([path], 'test', readable_paths=readable_paths)
+  stdout, _ = proc.communicate(timeout=60)
+  return proc.returncode, stdout
+
+def test_repeated_runs_get_fresh_data_segments(tmp_path):
+  # iovec {buf=16, len=3} followed by the bytes it points at
+  data = b'\x10\x00\x00\x00\x03\x00\x00\x00' + b'\x00' * 8 + b'hi\n'
+  path = _write(tmp_path, _module([FD_WRITE], WRITE_IOV, data))
+  for _ in range(3):
+    assert _run(path) == (0, b'hi\n')
+
+def test_readdir_lists_only_granted_files(tmp_path):
+  d = tmp_path / 'dir'
+  d.mkdir()
+  (d / 'granted').write_text('')
+  (d / 'secret').write_text('')
+  # fd_readdir(3, buf=64, buf_len=512, cookie=0, bufused=4) fills in the iovec's length
+  readdir = b'\x41\x03\x41\xc0\x00\x41\x80\x04\x42\x00\x41\x04\x10\x01\x1a'
+  module = _module([FD_WRITE, FD_READDIR], readdir + WRITE_IOV, b'\x40\x00\x00\x00')
+  returncode, stdout = _run(_write(tmp_path, module), [str(d / 'granted')])
+  assert returncode == 0
+  assert b'granted' in stdout
+  assert b'secret' not in stdout
@@ -0,0 +1,21 @@
+import sys, subprocess
+from .. import streaming
+
+def _stream(code, **kwargs):
+  proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  return list(streaming.OutputStream(proc, **kwargs))
+
+def test_ring_buffer_keeps_tail():
+  ring = streaming.RingBuffer(4)
+  ring.write(b'abc')
+  ring.write(b'def')
+  assert ring.getvalue() == b'cdef'
+
+def test_lines():
+  chunks = _stream('print("a"); print("b", end="")', lines=True)
+  assert chunks == [('stdout', b'a\n'), ('stdout', b'b')]
+
+def test_long_lines_are_not_buffered_past_tail_size():
+  chunks = _stream('import sys; sys.stdout.write("x" * 100000)', lines=True, tail_size=1024, chunk_size=512)
+  assert max(len(data) for _, data in chunks) < 2048
+  assert b''.join(data for _, data in chunks) == b'x' * 100000
@@ -0,0 +1,33 @@
+import os
+from .. import util
+
+def test_compact_paths_merges_siblings():
+  paths = ['/usr/lib/a', '/usr/lib/b', '/usr/lib/c', '/usr/lib/d']
+  assert util.compact_paths(paths) == ['/usr/lib']
+
+def test_compact_paths_needs_min_siblings():
+  paths = ['/usr/lib/a', '/usr/lib/b', '/usr/lib/c']
+  assert sorted(util.compact_paths(paths)) == paths
+
+def test_compact_paths_keeps_home_siblings_apart():
+  paths = ['/home/u/a', '/home/u/b', '/home/u/c', '/home/u/d']
+  assert sorted(util.compact_paths(paths)) == paths
+
+def test_compact_paths_keeps_root_siblings_apart():
+  paths = ['/root/x/a', '/root/x/b', '/root/x/c', '/root/x/d']
+  assert sorted(util.compact_paths(paths)) == paths
+
+def test_compact_paths_keeps_user_home_siblings_apart():
+  home = os.path.expanduser('~')
+  paths = [os.path.join(home, 'src', i) for i in 'abcd']
+  assert sorted(util.compact_paths(paths)) == paths
+
+def test_compact_paths_never_exposes_parent_of_denied_path():
+  paths = ['/etc/a', '/etc/b', '/etc/c', '/etc/d']
+  assert sorted(util.compact_paths(paths, min_depth=1)) == paths
+
+def test_path_set_drops_children_of_added_parent():
+  paths = util.PathSet(['/a/b', '/a/c'])
+  paths.add('/a')
+  assert list(paths) == ['/a']
+  assert '/a/b/c' in paths
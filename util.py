@@ -1,4 +1,5 @@
-import sys, os, tempfile
+import sys, os, tempfile, json, collections, errno
+from . import instrumentation
 
 def path_contains_or_is_in_path(allowed_path, path_being_tested):
   allowed_path = os.path.abspath(allowed_path)
@@ -7,7 +8,106 @@ def path_contains_or_is_in_path(allowed_path, path_being_tested):
   path_being_tested = path_being_tested.split(os.path.sep)
   return path_being_tested[:len(allowed_path)] == allowed_path
 
+class PathSet(object):
+  # Minimal cover of paths stored as a trie of path components. Paths covered by an
+  # existing entry are ignored and adding a parent drops every entry beneath it.
+  def __init__(self, paths=()):
+    self._root = {}
+    self._len = 0
+    self.update(paths)
+
+  @staticmethod
+  def _split(path):
+    return [i for i in os.path.abspath(path).split(os.path.sep) if i]
+
+  def add(self, path):
+    node = self._root
+    for part in self._split(path):
+      if None in node:
+        return False
+      node = node.setdefault(part, {})
+    if None in node:
+      return False
+    stack = [node]
+    while stack:
+      n = stack.pop()
+      for k,v in n.items():
+        if k is None:
+          self._len -= 1
+        else:
+          stack.append(v)
+    node.clear()
+    node[None] = path
+    self._len += 1
+    return True
+
+  def update(self, paths):
+    for path in paths:
+      self.add(path)
+
+  def covers(self, path):
+    node = self._root
+    for part in self._split(path):
+      if None in node:
+        return True
+      node = node.get(part)
+      if node is None:
+        return False
+    return None in node
+
+  __contains__ = covers
+
+  def clear(self):
+    self._root.clear()
+    self._len = 0
+
+  def __len__(self):
+    return self._len
+
+  def __iter__(self):
+    stack = [self._root]
+    while stack:
+      node = stack.pop()
+      for k,v in node.items():
+        if k is None:
+          yield v
+        else:
+          stack.append(v)
+
+  def __repr__(self):
+    return 'PathSet({})'.format(list(self))
+
+def dedupe_paths(paths):
+  return list(PathSet(paths))
+
+# Paths which compact_paths will never expose by merging binds into one of their parents
+DEFAULT_COMPACTION_DENY_PATHS = [
+  '/boot', '/dev', '/home', '/proc', '/root', '/run', '/sys', '/tmp', '/var',
+  '/etc/gshadow', '/etc/shadow', '/etc/ssh', '/etc/sudoers', '/etc/sudoers.d',
+  '~', '~/.aws', '~/.config', '~/.gnupg', '~/.ssh',
+]
+
+def compact_paths(paths, min_siblings=4, min_depth=2, deny_paths=DEFAULT_COMPACTION_DENY_PATHS):
+  deny_paths = [os.path.expanduser(i) for i in deny_paths]
+  result = PathSet(paths)
+  changed = True
+  while changed:
+    changed = False
+    parents = collections.Counter(os.path.dirname(os.path.abspath(i)) for i in result)
+    for parent, count in parents.items():
+      if count < min_siblings or len(PathSet._split(parent)) < min_depth:
+        continue
+      # A parent is never used if it is, contains or is inside a denied path
+      if any(path_contains_or_is_in_path(parent, i) or path_contains_or_is_in_path(i, parent) for i in deny_paths):
+        continue
+      if result.add(parent):
+        changed = True
+  return list(result)
+
 def add_path_if_unique(paths, new_path):
+  if isinstance(paths, PathSet):
+    paths.add(new_path)
+    return
   add_new_path = True
   for ipath in list(paths):
     if path_contains_or_is_in_path(ipath, new_path):
@@ -17,6 +117,14 @@ def add_path_if_unique(paths, new_path):
   if add_new_path:
     paths.add(new_path)
 
+def split_root(path):
+  # os.path.splitroot only exists on Python 3.12+
+  if hasattr(os.path, 'splitroot'):
+    return os.path.splitroot(path)
+  drive, rest = os.path.splitdrive(path)
+  tail = rest.lstrip(os.sep + (os.altsep or ''))
+  return drive, rest[:len(rest)-len(tail)], tail
+
 def get_keep_alive_handle(path):
   handle = tempfile.NamedTemporaryFile(prefix='.sandbox_dir_keep_alive_', dir=path)
   if sys.platform in ('win32', 'cygwin'):
@@ -25,6 +133,68 @@ def get_keep_alive_handle(path):
   return handle
 
 def ensure_dir_exists_and_get_keep_alive_handle(path):
-  try: os.mkdir(path)
-  except FileExistsError: pass
-  return get_keep_alive_handle(path)
+  with instrumentation.phase('keep_alive', path=path):
+    try: os.mkdir(path)
+    except FileExistsError: pass
+    return get_keep_alive_handle(path)
+
+def get_cache_dir():
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'sandboxpy')
+
+def load_cache(name):
+  try:
+    with open(os.path.join(get_cache_dir(), name), 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def save_cache(name, data):
+  d = get_cache_dir()
+  tmp = None
+  try:
+    os.makedirs(d, mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.'+name+'.', dir=d)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(data, f)
+    os.replace(tmp, os.path.join(d, name))
+  except OSError:
+    if tmp:
+      try: os.remove(tmp)
+      except OSError: pass
+
+def open_stdio(value, mode):
+  # Paths are opened for the caller and have to be closed once the process has been spawned
+  if isinstance(value, (str, bytes, os.PathLike)):
+    f = open(value, mode)
+    return f, f
+  return value, None
+
+def open_stdio_streams(stdin, stdout, stderr):
+  stdin, stdin_file = open_stdio(stdin, 'rb')
+  stdout, stdout_file = open_stdio(stdout, 'ab')
+  stderr, stderr_file = open_stdio(stderr, 'ab')
+  return (stdin, stdout, stderr), [i for i in (stdin_file, stdout_file, stderr_file) if i]
+
+def forward_fd(src, dst, chunk_size=1 << 20):
+  # Uses splice when either side is a pipe so the data never gets copied into python
+  splice = getattr(os, 'splice', None)
+  try:
+    while True:
+      if splice:
+        try:
+          if splice(src, dst, chunk_size) == 0:
+            break
+          continue
+        except OSError as ex:
+          if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            raise
+          splice = None
+      data = os.read(src, chunk_size)
+      if not data:
+        break
+      view = memoryview(data)
+      while view:
+        view = view[os.write(dst, view):]
+  except BrokenPipeError:
+    pass
@@ -1,9 +1,9 @@
-import os, subprocess, tempfile, shutil, hashlib, stat
-from . import util
+import os, subprocess, tempfile, shutil, hashlib, stat, asyncio
+from . import util, mirror, aot, backends, embedded, instrumentation, streaming
 
 DEFAULT_WASI_PYTHON = 'python/python'
 
-class SandboxedProcess(subprocess.Popen):
+class SandboxedProcess(streaming.StreamingProcess, instrumentation.TracedProcess, subprocess.Popen):
   pass
 
 def is_wasi_or_wasix(path):
@@ -38,50 +38,34 @@ def try_cleanup_mirror_dir(md, mp):
       shutil.rmtree(md)
     except FileNotFoundError:
       pass
+    try:
+      os.remove(md + mirror.MANIFEST_SUFFIX)
+    except FileNotFoundError:
+      pass
     try:
       os.rmdir(os.path.dirname(md))
     except OSError:
       pass
 
-def run(cmd,
-        id,
-        readable_paths=[],
-        writable_paths=[],
-        writable_paths_ensure_exists=[],
-        env=None,
-        cwd=None,
-        wasi_dependencies=[],
-        mirror_readable_paths=False,
-        **kwargs):
-  wasmer = shutil.which('wasmer')
-  if not wasmer:
-    wasmtime = shutil.which('wasmtime')
-    try:
-      from . import pywasix
-      return pywasix
-    except ModuleNotFoundError:
-      pass
-  if not wasmer and not wasmtime:
-    raise FileNotFoundError('Unable to find sandbox utilities or runtimes')
-  mp = {}
-  md = os.path.join(get_mirror_dir(), hashlib.sha256(id).hexdigest())
-  if len(readable_paths) > 0:
-    for path in readable_paths:
-      try:
-        st = os.stat(path)
-        if not mirror_readable_paths:
-          raise ValueError('Cannot use readable_paths with wasi when mirror_readable_paths is false')
-        try_cleanup_mirror_dir(md, mp)
-        _, _, tail = os.path.splitroot(path)
-        mpath = os.path.join(md, tail)
-        if stat.S_ISDIR(stat.st_mode):
-          shutil.copytree(path, os.path.join, dirs_exist_ok = True)
-        else:
-          os.makedirs(os.path.dirname(mpath), exist_ok = True)
-          shutil.copy2(path, mpath)
-        mp[path] = mpath
-      except FileNotFoundError:
-        pass
+def get_wasi_command(wasmer,
+                     wasmtime,
+                     cmd,
+                     id,
+                     readable_paths=[],
+                     writable_paths=[],
+                     writable_paths_ensure_exists=[],
+                     env=None,
+                     wasi_dependencies=[],
+                     mirror_readable_paths=False,
+                     aot_cache=aot.USE_AOT_CACHE,
+                     cwd=None,
+                     **kwargs):
+  md = os.path.join(get_mirror_dir(), hashlib.sha256(id.encode()).hexdigest())
+  with instrumentation.phase('wasi_mirror'):
+    existing = [i for i in readable_paths if os.path.exists(i)]
+    if existing and not mirror_readable_paths:
+      raise ValueError('Cannot use readable_paths with wasi when mirror_readable_paths is false')
+    mp = mirror.mirror_paths(existing, md) if existing else {}
   try_cleanup_mirror_dir(md, mp)
   dir_keep_alive_handles = []
   if wasmer:
@@ -96,9 +80,11 @@ def run(cmd,
       if stat.S_ISDIR(st.st_mode):
         mpath = path
       else:
-        _, _, tail = os.path.splitroot(path)
+        _, _, tail = util.split_root(os.path.abspath(path))
         mpath = os.path.join(md, tail)
         os.makedirs(os.path.dirname(mpath), exist_ok = True)
+        if os.path.lexists(mpath):
+          os.remove(mpath)
         os.symlink(os.path.abspath(path), mpath)
       wcmd += ['--mapdir' if wasmer else '--dir', path+'::'+mpath]
     except FileNotFoundError:
@@ -113,19 +99,145 @@ def run(cmd,
   if env is not None:
     for k,v in env.items():
       wcmd += ['--env', str(k)+'='+str(v)]
+  module = cmd[0]
+  # wasmer keeps its own cache of compiled modules and can't set argv[0] for
+  # an artifact, wasmtime is told the original name with --argv0
+  if aot_cache and not wasmer:
+    with instrumentation.phase('aot_cache'):
+      # The runtime resolves the module relative to the sandbox's cwd
+      precompiled = aot.get_precompiled('wasmtime', wasmtime, os.path.join(cwd or '', module))
+    if precompiled is not None:
+      wcmd += ['--allow-precompiled', '--argv0', module]
+      module = precompiled
   if wasmer:
-    wcmd += [cmd[0], '--'] + cmd[1:]
+    wcmd += [module, '--'] + cmd[1:]
   else:
-    wcmd += cmd
-  proc = SandboxedProcess(
-          wcmd,
-          stdin = subprocess.PIPE,
-          stdout = subprocess.PIPE,
-          stderr = subprocess.PIPE,
-          cwd=cwd,
-        )
-  proc.dir_keep_alive_handles = dir_keep_alive_handles
-  return proc
+    wcmd += [module] + cmd[1:]
+  return wcmd, dir_keep_alive_handles
+
+def run(cmd,
+        id,
+        readable_paths=[],
+        writable_paths=[],
+        writable_paths_ensure_exists=[],
+        env=None,
+        cwd=None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        wasi_dependencies=[],
+        mirror_readable_paths=False,
+        **kwargs):
+  if kwargs.get('embedded', embedded.USE_EMBEDDED) and backends.get_backend('wasmtime-py'):
+    return embedded.run(cmd,
+                        id,
+                        readable_paths = readable_paths,
+                        writable_paths = writable_paths,
+                        writable_paths_ensure_exists = writable_paths_ensure_exists,
+                        env = env,
+                        cwd = cwd,
+                        stdin = stdin,
+                        stdout = stdout,
+                        stderr = stderr,
+                        **kwargs)
+  wasmer = None if kwargs.get('in_process') else backends.get_path('wasmer')
+  wasmtime = None if wasmer or kwargs.get('in_process') else backends.get_path('wasmtime')
+  if not wasmer and not wasmtime and backends.get_backend('pywasix'):
+    # Runs on pywasm in this process which needs neither a runtime nor mirroring
+    from . import pywasix
+    return pywasix.run(cmd,
+                       id,
+                       readable_paths = readable_paths,
+                       writable_paths = writable_paths,
+                       writable_paths_ensure_exists = writable_paths_ensure_exists,
+                       env = env,
+                       cwd = cwd,
+                       stdin = stdin,
+                       stdout = stdout,
+                       stderr = stderr,
+                       **kwargs)
+  if not wasmer and not wasmtime:
+    raise FileNotFoundError('Unable to find sandbox utilities or runtimes')
+  with instrumentation.launch(id, 'wasmer' if wasmer else 'wasmtime'):
+    with instrumentation.phase('build_command'):
+      wcmd, dir_keep_alive_handles = get_wasi_command(wasmer,
+                                                      wasmtime,
+                                                      cmd,
+                                                      id,
+                                                      readable_paths = readable_paths,
+                                                      writable_paths = writable_paths,
+                                                      writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                                      env = env,
+                                                      wasi_dependencies = wasi_dependencies,
+                                                      mirror_readable_paths = mirror_readable_paths,
+                                                      cwd = cwd,
+                                                      **kwargs)
+    (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+    try:
+      with instrumentation.phase('spawn'):
+        proc = SandboxedProcess(
+                wcmd,
+                stdin = stdin,
+                stdout = stdout,
+                stderr = stderr,
+                cwd=cwd,
+              )
+    finally:
+      for f in stdio_files:
+        f.close()
+    proc.dir_keep_alive_handles = dir_keep_alive_handles
+    instrumentation.track_process(proc)
+    return proc
+
+async def run_async(cmd,
+                    id,
+                    readable_paths=[],
+                    writable_paths=[],
+                    writable_paths_ensure_exists=[],
+                    env=None,
+                    cwd=None,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    wasi_dependencies=[],
+                    mirror_readable_paths=False,
+                    **kwargs):
+  wasmer = backends.get_path('wasmer')
+  wasmtime = None if wasmer else backends.get_path('wasmtime')
+  if not wasmer and not wasmtime:
+    raise FileNotFoundError('Unable to find sandbox utilities or runtimes')
+  with instrumentation.launch(id, 'wasmer' if wasmer else 'wasmtime'):
+    with instrumentation.phase('build_command'):
+      # Mirroring and precompiling touch the disk so they're kept off the event loop
+      wcmd, dir_keep_alive_handles = await asyncio.to_thread(get_wasi_command,
+                                                             wasmer,
+                                                             wasmtime,
+                                                             cmd,
+                                                             id,
+                                                             readable_paths = readable_paths,
+                                                             writable_paths = writable_paths,
+                                                             writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                                             env = env,
+                                                             wasi_dependencies = wasi_dependencies,
+                                                             mirror_readable_paths = mirror_readable_paths,
+                                                             cwd = cwd,
+                                                             **kwargs)
+    (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+    try:
+      with instrumentation.phase('spawn'):
+        proc = await asyncio.create_subprocess_exec(
+                *wcmd,
+                stdin = stdin,
+                stdout = stdout,
+                stderr = stderr,
+                cwd=cwd,
+              )
+    finally:
+      for f in stdio_files:
+        f.close()
+    proc.dir_keep_alive_handles = dir_keep_alive_handles
+    instrumentation.track_process(proc)
+    return proc
 
 def run_python(cmd,
                id,
@@ -154,6 +266,33 @@ def run_python(cmd,
              mirror_readable_paths = mirror_readable_paths,
              **kwargs)
 
+async def run_python_async(cmd,
+                           id,
+                           readable_paths=[],
+                           writable_paths=[],
+                           writable_paths_ensure_exists=[],
+                           env=None,
+                           cwd=None,
+                           wasi_dependencies=[],
+                           mirror_readable_paths=False,
+                           wasi_python=None,
+                           wasi_python_readable_paths=None,
+                           **kwargs):
+  if wasi_python is None:
+    wasi_python = os.environ.get('WASI_PYTHON', DEFAULT_WASI_PYTHON)
+  if wasi_python_readable_paths is None:
+    wasi_python_readable_paths = os.environ.get('WASI_PYTHON_READABLE_PATHS', [])
+  return await run_async([wasi_python] + cmd,
+                         id,
+                         readable_paths = wasi_python_readable_paths + readable_paths,
+                         writable_paths = writable_paths,
+                         writable_paths_ensure_exists = writable_paths_ensure_exists,
+                         env = env,
+                         cwd = cwd,
+                         wasi_dependencies = wasi_dependencies,
+                         mirror_readable_paths = mirror_readable_paths,
+                         **kwargs)
+
 def delete_all_sandboxes():
   try:
     shutil.rmtree(get_mirror_dir())
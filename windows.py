@@ -2,7 +2,7 @@ import os, json, ctypes, hashlib, sys, shutil
 from ctypes import wintypes
 from . import wincontainer, winproc
 from .winproc import SandboxedProcess
-from . import util
+from . import util, instrumentation
 
 MAX_APPCONTAINER_NAME = 50
 
@@ -79,7 +79,8 @@ def run(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensure_exi
         created = True
       except FileExistsError:
         created = False
-      dir_keep_alive_handles.append(util.get_keep_alive_handle(new_path))
+      with instrumentation.phase('keep_alive', path=new_path):
+        dir_keep_alive_handles.append(util.get_keep_alive_handle(new_path))
       different_from_old_container = not old_container or new_path not in old_container['writable_paths_ensure_exists']
       if different_from_old_container or created:
         wincontainer.add_write_file_permission(container, new_path)
@@ -105,7 +106,8 @@ def run(cmd, id, readable_paths=[], writable_paths=[], writable_paths_ensure_exi
     stdin_read = winproc.make_inheritable(stdin_read)
     stdout_write = winproc.make_inheritable(stdout_write)
 
-    pi = wincontainer.execute(container, cmd, env=env, cwd=cwd, stdin=stdin_read, stdout=stdout_write)
+    with instrumentation.launch(id, 'appcontainer'), instrumentation.phase('spawn'):
+      pi = wincontainer.execute(container, cmd, env=env, cwd=cwd, stdin=stdin_read, stdout=stdout_write)
     proc.pid = pi.dwProcessId
     proc.proc = pi.hProcess
     proc.dir_keep_alive_handles = dir_keep_alive_handles
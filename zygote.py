@@ -0,0 +1,372 @@
+import os, sys, json, socket, asyncio, weakref, warnings, itertools, subprocess, threading
+from . import util, linux, cgroups, backends, inprocess, streaming, instrumentation
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zygote_server.py')
+PREFLIGHT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preflight.py')
+
+# Imported by the zygote before it starts forking so that children don't pay for them
+DEFAULT_PREIMPORT = ['json', 'socket', 'sqlite3', 'ssl', 'threading']
+
+# Options which only make sense for a sandbox of its own, children are
+# forked from the zygote so they can't have them
+UNSUPPORTED_OPTIONS = ('pass_fds', 'persistent', 'force_wasi', 'in_process', 'embedded')
+
+MAX_MESSAGE_SIZE = 1 << 20
+STDERR_TAIL_SIZE = 1 << 16
+
+_lock = threading.Lock()
+_zygotes = {}
+_child_cgroups = itertools.count()
+
+class ZygoteProcess(instrumentation.TracedProcess, inprocess.ProcessHandle):
+  def __init__(self, zygote, args, stdin_fd, stdout_fd, stderr_fd):
+    self.args = args
+    # Children are forked by the zygote so they have no pid in the host's
+    # namespace, sandbox_pid is only meaningful inside the sandbox and signals
+    # have to go through send_signal()
+    self.pid = None
+    self.sandbox_pid = None
+    self.returncode = None
+    self.cgroup = None
+    self.dir_keep_alive_handles = zygote.proc.dir_keep_alive_handles
+    self.stdin = None if stdin_fd is None else open(stdin_fd, 'wb')
+    self.stdout = None if stdout_fd is None else open(stdout_fd, 'rb')
+    self.stderr = None if stderr_fd is None else open(stderr_fd, 'rb')
+    self._zygote = zygote
+    self._started = threading.Event()
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._readers = None
+
+  def send_signal(self, sig):
+    if self.returncode is None:
+      self._zygote._send({'kill': self._id, 'signal': int(sig)})
+
+
+class AsyncZygoteProcess(object):
+  # What run_async returns for persistent sandboxes, waiting is done on a
+  # thread and the pipes are regular files rather than streams
+  def __init__(self, proc):
+    self._proc = proc
+    self.pid = proc.pid
+    self.sandbox_pid = proc.sandbox_pid
+    self.cgroup = proc.cgroup
+    self.dir_keep_alive_handles = proc.dir_keep_alive_handles
+    self.stdin, self.stdout, self.stderr = proc.stdin, proc.stdout, proc.stderr
+
+  @property
+  def returncode(self):
+    return self._proc.returncode
+
+  async def wait(self):
+    return await asyncio.to_thread(self._proc.wait)
+
+  async def communicate(self, input=None):
+    return await asyncio.to_thread(self._proc.communicate, input)
+
+  def send_signal(self, sig):
+    self._proc.send_signal(sig)
+
+  def terminate(self):
+    self._proc.terminate()
+
+  def kill(self):
+    self._proc.kill()
+
+
+def _get_stdio_fds(stdio):
+  # Returns the fds to send to the zygote, which are all owned by the caller,
+  # and the parent ends of any pipes
+  child_fds, parent_fds = [], []
+  try:
+    for i, value in enumerate(stdio):
+      parent_fd = None
+      if value == subprocess.PIPE:
+        r, w = os.pipe()
+        child_fd, parent_fd = (r, w) if i == 0 else (w, r)
+      elif value == subprocess.DEVNULL:
+        child_fd = os.open(os.devnull, os.O_RDONLY if i == 0 else os.O_WRONLY)
+      elif value == subprocess.STDOUT:
+        child_fd = os.dup(child_fds[1])
+      else:
+        child_fd = os.dup(i if value is None else value if isinstance(value, int) else value.fileno())
+      child_fds.append(child_fd)
+      parent_fds.append(parent_fd)
+  except:
+    for fd in child_fds + [i for i in parent_fds if i is not None]:
+      os.close(fd)
+    raise
+  return child_fds, parent_fds
+
+def _prepare_limits(id, limits):
+  # Each child gets its own cgroup, which it joins by writing to an fd for its
+  # cgroup.procs, or otherwise rlimits which it sets itself before the command
+  # runs. Returns the cgroup's id, that fd and the rlimits.
+  if all(limits.get(i) is None for i in cgroups.LIMITS):
+    return None, None, {}
+  cgroup_id = '{}#{}'.format(id, next(_child_cgroups))
+  try:
+    cgroup = cgroups.get_cgroup(cgroup_id)
+    cgroup.set_limits(**limits)
+    return cgroup_id, os.open(os.path.join(cgroup.path, 'cgroup.procs'), os.O_WRONLY | os.O_CLOEXEC), {}
+  except OSError:
+    cgroups.delete_cgroup(cgroup_id)
+    return None, None, cgroups.get_rlimits(**limits)
+
+
+class Zygote(object):
+  def __init__(self,
+               id,
+               readable_paths=[],
+               writable_paths=[],
+               writable_paths_ensure_exists=[],
+               env=None,
+               cwd=None,
+               preimport=DEFAULT_PREIMPORT,
+               safeguards=False,
+               **kwargs):
+    if not backends.get_usable_path('bwrap'):
+      raise FileNotFoundError('Zygotes require a usable bwrap')
+    self.id = id
+    self._sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    config = {'preimport': list(preimport), 'safeguards': safeguards, 'preflight': PREFLIGHT_PATH}
+    preflight_paths = [SERVER_PATH, PREFLIGHT_PATH]
+    if safeguards:
+      from . import preflight
+      if preflight.USE_SECCOMP:
+        # The filter is compiled out here so the zygote needs neither libseccomp nor a writable cache
+        try:
+          bpf_paths = preflight.precompile_seccomp_filters()
+          config['seccomp_cache_dir'] = os.path.dirname(bpf_paths[0])
+          preflight_paths += bpf_paths
+        except (ImportError, OSError) as ex:
+          warnings.warn('Unable to precompile the seccomp filter: {}'.format(ex))
+    try:
+      # The zygote is traced as a launch of its own rather than part of the run that needed it
+      with instrumentation.detached():
+        self.proc = linux.run([sys.executable, SERVER_PATH, str(child_sock.fileno()), json.dumps(config)],
+                              id,
+                              readable_paths = linux.get_python_paths() + preflight_paths + readable_paths,
+                              writable_paths = writable_paths,
+                              writable_paths_ensure_exists = writable_paths_ensure_exists,
+                              env = env,
+                              cwd = cwd,
+                              stdin = subprocess.DEVNULL,
+                              stdout = subprocess.DEVNULL,
+                              pass_fds = (child_sock.fileno(),),
+                              **kwargs)
+    finally:
+      child_sock.close()
+    # The zygote's stderr is only kept to explain why it died, it has to be
+    # drained so that it can't block on a full pipe
+    self.stderr_tail = streaming.RingBuffer(STDERR_TAIL_SIZE)
+    self._drainer = threading.Thread(target=self._drain_stderr, daemon=True)
+    self._drainer.start()
+    self._lock = threading.Lock()
+    self._next_id = 0
+    self._procs = {}
+    self._reader = threading.Thread(target=self._read_worker, daemon=True)
+    self._reader.start()
+
+  def _drain_stderr(self):
+    while True:
+      b = self.proc.stderr.read1(65536)
+      if not b:
+        break
+      self.stderr_tail.write(b)
+    self.proc.stderr.close()
+
+  def is_alive(self):
+    return self.proc.poll() is None and self._reader.is_alive()
+
+  def _send(self, msg, fds=[]):
+    socket.send_fds(self._sock, [json.dumps(msg).encode()], fds)
+
+  def _read_worker(self):
+    while True:
+      try:
+        data = self._sock.recv(MAX_MESSAGE_SIZE)
+      except OSError:
+        data = None
+      if not data:
+        break
+      msg = json.loads(data)
+      with self._lock:
+        proc = self._procs.get(msg['id'])
+        if 'returncode' in msg:
+          self._procs.pop(msg['id'], None)
+      if proc is None:
+        continue
+      if 'pid' in msg:
+        proc.sandbox_pid = msg['pid']
+        proc._started.set()
+      if 'returncode' in msg:
+        proc.returncode = msg['returncode']
+        proc._done.set()
+        proc._emit_exit()
+      # Not kept alive by this frame while waiting for the next message
+      proc = None
+    # The zygote is gone, so anything still running went with it
+    with self._lock:
+      procs, self._procs = self._procs, {}
+    for proc in procs.values():
+      if proc.returncode is None:
+        proc.returncode = -9
+      proc._started.set()
+      proc._done.set()
+
+  def _spawn(self, request, stdio, limits={}):
+    child_fds, parent_fds = _get_stdio_fds(stdio)
+    try:
+      cgroup_id, cgroup_fd, request['rlimits'] = _prepare_limits(self.id, limits)
+    except:
+      for fd in child_fds + [i for i in parent_fds if i is not None]:
+        os.close(fd)
+      raise
+    if cgroup_fd is not None:
+      child_fds.append(cgroup_fd)
+      request['cgroup'] = True
+    proc = ZygoteProcess(self, request['cmd'], *parent_fds)
+    if cgroup_id is not None:
+      proc.cgroup = cgroups.get_cgroup(cgroup_id)
+      # The cgroup goes once nothing refers to the process and it's empty
+      weakref.finalize(proc, cgroups.delete_cgroup, cgroup_id)
+    try:
+      with self._lock:
+        proc._id = request['id'] = self._next_id
+        self._next_id += 1
+        self._procs[proc._id] = proc
+        try:
+          self._send(request, child_fds)
+        except OSError:
+          del self._procs[proc._id]
+          raise
+    finally:
+      for fd in child_fds:
+        os.close(fd)
+    proc._started.wait()
+    return proc
+
+  def run_python(self, cmd, env=None, cwd=None, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, limits={}):
+    return self._spawn({'cmd': cmd, 'env': env, 'cwd': cwd}, (stdin, stdout, stderr), limits)
+
+  def run(self, cmd, env=None, cwd=None, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, limits={}):
+    # Executes cmd in the zygote's namespaces instead of running it as python
+    return self._spawn({'cmd': cmd, 'env': env, 'cwd': cwd, 'exec': True}, (stdin, stdout, stderr), limits)
+
+  def close(self):
+    try:
+      self._sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+    self._sock.close()
+    try:
+      self.proc.wait(1)
+    except subprocess.TimeoutExpired:
+      self.proc.kill()
+      self.proc.wait()
+    self._reader.join(1)
+    self._drainer.join(1)
+
+
+def _get_key(id, readable_paths, writable_paths, writable_paths_ensure_exists, env, cwd, preimport, safeguards, kwargs):
+  return json.dumps([id, sorted(readable_paths), sorted(writable_paths), sorted(writable_paths_ensure_exists),
+                     env, cwd, list(preimport), safeguards, sorted(kwargs.items())], default=str)
+
+def get_zygote(id,
+               readable_paths=[],
+               writable_paths=[],
+               writable_paths_ensure_exists=[],
+               env=None,
+               cwd=None,
+               preimport=DEFAULT_PREIMPORT,
+               safeguards=False,
+               **kwargs):
+  key = _get_key(id, readable_paths, writable_paths, writable_paths_ensure_exists, env, cwd, preimport, safeguards, kwargs)
+  with _lock:
+    zygote = _zygotes.get(key)
+    if zygote is not None and not zygote.is_alive():
+      # Reaps the dead zygote and lets its reader and drainer threads finish
+      del _zygotes[key]
+      zygote.close()
+      zygote = None
+    if zygote is None:
+      zygote = _zygotes[key] = Zygote(id,
+                                      readable_paths = readable_paths,
+                                      writable_paths = writable_paths,
+                                      writable_paths_ensure_exists = writable_paths_ensure_exists,
+                                      env = env,
+                                      cwd = cwd,
+                                      preimport = preimport,
+                                      safeguards = safeguards,
+                                      **kwargs)
+    return zygote
+
+def _check_options(kwargs):
+  unsupported = sorted(i for i in UNSUPPORTED_OPTIONS if kwargs.get(i))
+  if unsupported:
+    raise ValueError('Not supported by zygotes: {}'.format(', '.join(unsupported)))
+
+def _spawn_child(spawn, cmd, env, cwd, stdin, stdout, stderr, limits):
+  (stdin, stdout, stderr), stdio_files = util.open_stdio_streams(stdin, stdout, stderr)
+  try:
+    return spawn(cmd, env=env, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr, limits=limits)
+  finally:
+    for f in stdio_files:
+      f.close()
+
+def run_python(cmd,
+               id,
+               readable_paths=[],
+               writable_paths=[],
+               writable_paths_ensure_exists=[],
+               env=None,
+               cwd=None,
+               stdin=subprocess.PIPE,
+               stdout=subprocess.PIPE,
+               stderr=subprocess.PIPE,
+               preimport=DEFAULT_PREIMPORT,
+               safeguards=False,
+               **kwargs):
+  # Limits apply to each child rather than the zygote, everything else
+  # configures the zygote's sandbox
+  _check_options(kwargs)
+  limits = {i: kwargs.pop(i) for i in cgroups.LIMITS if i in kwargs}
+  zygote = get_zygote(id,
+                      readable_paths = readable_paths,
+                      writable_paths = writable_paths,
+                      writable_paths_ensure_exists = writable_paths_ensure_exists,
+                      preimport = preimport,
+                      safeguards = safeguards,
+                      **kwargs)
+  return _spawn_child(zygote.run_python, cmd, env, cwd, stdin, stdout, stderr, limits)
+
+def run(cmd,
+        id,
+        readable_paths=[],
+        writable_paths=[],
+        writable_paths_ensure_exists=[],
+        env=None,
+        cwd=None,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        **kwargs):
+  # Persistent sandboxes, the zygote for an id and set of paths holds the
+  # namespaces and every later run is forked from it and executes cmd
+  _check_options(kwargs)
+  limits = {i: kwargs.pop(i) for i in cgroups.LIMITS if i in kwargs}
+  zygote = get_zygote(id,
+                      readable_paths = readable_paths,
+                      writable_paths = writable_paths,
+                      writable_paths_ensure_exists = writable_paths_ensure_exists,
+                      preimport = [],
+                      **kwargs)
+  return zygote.run(cmd, env=env, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr, limits=limits)
+
+def shutdown_all():
+  with _lock:
+    zygotes = list(_zygotes.values())
+    _zygotes.clear()
+  for zygote in zygotes:
+    zygote.close()
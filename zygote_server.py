@@ -0,0 +1,145 @@
+# Runs inside the sandbox as the zygote for zygote.py
+# This is executed as a standalone script so it must not import anything from the package
+
+import os, sys, json, socket, signal, select, runpy, resource, traceback, importlib.util
+
+MAX_MESSAGE_SIZE = 1 << 20
+
+def load_preflight(path):
+  spec = importlib.util.spec_from_file_location('sandboxpy_preflight', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def send(sock, msg):
+  sock.send(json.dumps(msg).encode())
+
+def apply_limits(request, cgroup_fd):
+  # The child joins its own cgroup, which the broker opened for it, or sets
+  # its rlimits before anything else runs
+  if cgroup_fd is not None:
+    os.write(cgroup_fd, b'0')
+    os.close(cgroup_fd)
+  for name, value in request.get('rlimits', {}).items():
+    resource.setrlimit(getattr(resource, name), (value, value))
+
+def run_child(request, fds, preflight):
+  code = 1
+  try:
+    cgroup_fd = fds.pop() if request.get('cgroup') else None
+    for i, fd in enumerate(fds):
+      os.dup2(fd, i)
+      os.close(fd)
+    try:
+      apply_limits(request, cgroup_fd)
+    except (OSError, ValueError) as ex:
+      os.write(2, 'Unable to apply limits: {}\n'.format(ex).encode(errors='replace'))
+      code = 126
+      return
+    if preflight:
+      preflight.enable_default_safeguards()
+    if request.get('env') is not None:
+      os.environ.clear()
+      os.environ.update(request['env'])
+    if request.get('cwd'):
+      os.chdir(request['cwd'])
+    argv = request['cmd']
+    if request.get('exec'):
+      try:
+        os.execvp(argv[0], argv)
+      except OSError as ex:
+        os.write(2, '{}: {}\n'.format(argv[0], ex).encode(errors='replace'))
+        code = 127
+        return
+    code = 0
+    try:
+      if argv[0] == '-c':
+        sys.argv = ['-c'] + argv[2:]
+        exec(compile(argv[1], '<string>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+      elif argv[0] == '-m':
+        sys.argv = argv[1:]
+        runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+      else:
+        sys.argv = argv
+        runpy.run_path(argv[0], run_name='__main__')
+    except SystemExit as ex:
+      if ex.code is None:
+        code = 0
+      elif isinstance(ex.code, int):
+        code = ex.code
+      else:
+        print(ex.code, file=sys.stderr)
+        code = 1
+    except BaseException:
+      traceback.print_exc()
+      code = 1
+    for f in (sys.stdout, sys.stderr):
+      try:
+        f.flush()
+      except Exception:
+        pass
+  finally:
+    os._exit(code)
+
+def main():
+  sock = socket.socket(fileno=int(sys.argv[1]))
+  config = json.loads(sys.argv[2])
+  for name in config.get('preimport', []):
+    __import__(name)
+  preflight = load_preflight(config['preflight']) if config.get('safeguards') else None
+  if preflight and config.get('seccomp_cache_dir'):
+    preflight.SECCOMP_CACHE_DIR = config['seccomp_cache_dir']
+
+  wake_r, wake_w = os.pipe()
+  os.set_blocking(wake_w, False)
+  signal.set_wakeup_fd(wake_w)
+  signal.signal(signal.SIGCHLD, lambda *args: None)
+
+  children = {}
+  while True:
+    try:
+      ready, _, _ = select.select([sock, wake_r], [], [])
+    except InterruptedError:
+      continue
+
+    if wake_r in ready:
+      os.read(wake_r, 4096)
+      while children:
+        try:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+          break
+        if pid == 0:
+          break
+        rid = children.pop(pid, None)
+        if rid is not None:
+          send(sock, {'id': rid, 'returncode': os.waitstatus_to_exitcode(status)})
+
+    if sock in ready:
+      data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 4)
+      if not data:
+        break
+      request = json.loads(data)
+      if 'kill' in request:
+        for pid, rid in children.items():
+          if rid == request['kill']:
+            try:
+              os.kill(pid, request['signal'])
+            except ProcessLookupError:
+              pass
+        continue
+      pid = os.fork()
+      if pid == 0:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in (wake_r, wake_w):
+          os.close(fd)
+        sock.close()
+        run_child(request, fds, preflight)
+      for fd in fds:
+        os.close(fd)
+      children[pid] = request['id']
+      send(sock, {'id': request['id'], 'pid': pid})
+
+if __name__ == '__main__':
+  main()